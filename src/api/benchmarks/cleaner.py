@@ -0,0 +1,74 @@
+"""Compare the BeautifulSoup and lxml part cleaners on the bundled sample story.
+
+Usage (from src/api):
+    python benchmarks/cleaner.py [--rounds 20]
+"""
+
+import argparse
+import html
+import re
+import sys
+import time
+from pathlib import Path
+from zipfile import ZipFile
+
+sys.path.insert(0, str(Path(__file__).parents[1] / "src"))
+
+from create_book.cleaner import clean_part
+from create_book.parser import clean_tree, tree_image_urls
+
+SAMPLE = Path(__file__).parents[3] / "samples" / "wattpad-books-presents_237369078.epub"
+
+
+def load_parts() -> list[tuple[str, int, str]]:
+    """Chapters of the sample EPUB, which embed each part's HTML as Wattpad serves it."""
+    parts = []
+    with ZipFile(SAMPLE) as archive:
+        for name in archive.namelist():
+            if not (match := re.search(r"/\d+_(\d+)\.xhtml$", name)):
+                continue
+
+            chapter = archive.read(name).decode("utf-8")
+            title, body = re.search(
+                r"<body><h1>(.*?)</h1>(.*)</body>", chapter, re.DOTALL
+            ).groups()
+            parts.append((html.unescape(title), int(match.group(1)), body))
+
+    return parts
+
+
+def bs4_engine(title: str, id: int, body: str) -> tuple[str, list[str]]:
+    tree = clean_tree(title, id, body)
+    return str(tree), tree_image_urls(tree)
+
+
+def lxml_engine(title: str, id: int, body: str) -> tuple[str, list[str]]:
+    return tuple(clean_part(title, id, body))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rounds", type=int, default=20)
+    args = parser.parse_args()
+
+    parts = load_parts()
+    size = sum(len(body) for _, _, body in parts)
+    print(f"{len(parts)} parts, {size / 1024:.0f} KiB of HTML, {args.rounds} rounds")
+
+    for part in parts:
+        assert bs4_engine(*part) == lxml_engine(*part), f"Output differs for {part[1]}"
+
+    timings = {}
+    for name, engine in [("bs4", bs4_engine), ("lxml", lxml_engine)]:
+        start = time.perf_counter()
+        for _ in range(args.rounds):
+            for part in parts:
+                engine(*part)
+        timings[name] = (time.perf_counter() - start) / (args.rounds * len(parts))
+        print(f"{name:>5}: {timings[name] * 1000:.3f} ms/part")
+
+    print(f"lxml is {timings['bs4'] / timings['lxml']:.1f}x faster, output identical")
+
+
+if __name__ == "__main__":
+    main()
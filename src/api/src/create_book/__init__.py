@@ -2,12 +2,21 @@
 
 from .create_book import (
     fetch_cookies,
+    fetch_session,
     fetch_story,
     fetch_story_content_zip,
     fetch_story_from_partId,
 )
-from .exceptions import PartNotFoundError, StoryNotFoundError, WattpadError
-from .generators import EPUBGenerator, MOBIGenerator, PDFGenerator
+from .exceptions import (
+    BuildQueueFullError,
+    MissingCoverError,
+    PartNotFoundError,
+    RateLimitedError,
+    StoryNotFoundError,
+    WattpadError,
+)
+from .generators import EPUBGenerator, EPUBStreamWriter, MOBIGenerator, PDFGenerator
 from .logs import logger
 from .parser import fetch_image
 from .utils import slugify
+from .vars import clients
@@ -0,0 +1,31 @@
+from hashlib import sha256
+
+from .images import image_preset
+from .models import Story
+from .singleflight import SingleFlight
+from .storage import create_store
+from .vars import config
+
+ARTIFACT_VERSION = 2  # Bump when generator output changes, invalidating cached books.
+
+artifact_store = create_store(
+    "artifacts", config.ARTIFACT_CACHE_MAX_BYTES, config.ARTIFACT_CACHE_TTL
+)
+builds: SingleFlight[None] = SingleFlight()
+
+
+def artifact_key(story: Story, format: str, download_images: bool) -> str:
+    """Content address of a rendered book. Any change to the story bumps `modifyDate`, so stale books are never served."""
+    part_ids = ",".join(str(part["id"]) for part in story["parts"])
+    images = "none"
+    if download_images:
+        # Every processing setting, changing any of them changes the book.
+        images = (
+            ":".join(map(str, image_preset(format)))
+            if config.IMAGE_PROCESSING
+            else "original"
+        )
+
+    return sha256(
+        f"{ARTIFACT_VERSION}|{story['id']}|{story['modifyDate']}|{part_ids}|{format}|{images}".encode()
+    ).hexdigest()
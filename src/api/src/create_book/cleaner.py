@@ -0,0 +1,226 @@
+"""Single-pass part cleaner on lxml, producing the same markup as `parser.clean_tree`."""
+
+import re
+from typing import NamedTuple
+
+from lxml import etree
+
+TEXT_TAGS = frozenset([None, "b", "i", "u", "strong", "em"])
+
+# Serialization rules of BeautifulSoup's default formatter, which defines `clean_tree`'s output.
+VOID_ELEMENTS = frozenset(
+    [
+        "area", "base", "br", "col", "embed", "hr", "img", "input", "keygen", "link",
+        "menuitem", "meta", "param", "source", "track", "wbr", "basefont", "bgsound",
+        "command", "frame", "image", "isindex", "nextid", "spacer",
+    ]
+)  # fmt: skip
+RAW_TEXT_ELEMENTS = frozenset(["script", "style"])
+LIST_ATTRIBUTES = {
+    "*": ["class", "accesskey", "dropzone"],
+    "a": ["rel", "rev"],
+    "link": ["rel", "rev"],
+    "td": ["headers"],
+    "th": ["headers"],
+    "form": ["accept-charset"],
+    "object": ["archive"],
+    "area": ["rel"],
+    "icon": ["sizes"],
+    "iframe": ["sandbox"],
+    "output": ["for"],
+}
+PRESERVE_WHITESPACE_ELEMENTS = frozenset(["pre", "textarea"])
+ASCII_WHITESPACE = " \n\t\x0c\r"
+_nonwhitespace = re.compile(r"\S+")
+
+
+class CleanedPart(NamedTuple):
+    html: str
+    images: list[str]  # <img> sources, in document order
+
+
+class _Comment(str):
+    pass
+
+
+class _ProcessingInstruction(str):
+    pass
+
+
+# [name, attributes, children], children being elements or strings.
+Element = list
+
+
+class _TreeBuilder:
+    """lxml parser target building a minimal tree, the way BeautifulSoup's lxml builder does.
+
+    Building from parser events rather than an lxml tree matters: lxml fills in valueless attributes (`disabled="disabled"`), and BeautifulSoup collapses whitespace-only strings.
+    """
+
+    def __init__(self):
+        self.root: Element = ["", {}, []]
+        self.stack: list[Element] = [self.root]
+        self.body: Element | None = None
+        self.text: list[str] = []
+
+    def _flush(self, kind=str):
+        if not self.text:
+            return
+
+        text = "".join(self.text)
+        self.text = []
+        if not text.strip(ASCII_WHITESPACE) and not any(
+            element[0] in PRESERVE_WHITESPACE_ELEMENTS for element in self.stack
+        ):
+            text = "\n" if "\n" in text else " "
+        self.stack[-1][2].append(kind(text))
+
+    def start(self, tag: str, attrib: dict[str, str]):
+        self._flush()
+        element = [tag, dict(attrib), []]
+        self.stack[-1][2].append(element)
+        self.stack.append(element)
+        if tag == "body" and self.body is None:
+            self.body = element
+
+    def end(self, tag: str):
+        self._flush()
+        self.stack.pop()
+
+    def data(self, data: str):
+        self.text.append(data)
+
+    def comment(self, text: str):
+        self._flush()
+        self.text.append(text)
+        self._flush(_Comment)
+
+    def pi(self, target: str, data: str):
+        self._flush()
+        self.text.append(f"{target} {data}")
+        self._flush(_ProcessingInstruction)
+
+    def close(self) -> Element | None:
+        self._flush()
+        return self.body
+
+
+def _escape(text: str) -> str:
+    return text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+
+
+def _attributes(tag: str, attributes: dict[str, str | None]) -> str:
+    list_attributes = LIST_ATTRIBUTES["*"] + LIST_ATTRIBUTES.get(tag, [])
+
+    output = ""
+    for name, value in sorted(attributes.items()):
+        if value is None:
+            output += f" {name}"
+            continue
+
+        if name in list_attributes:
+            value = " ".join(_nonwhitespace.findall(value))
+
+        value = _escape(value)
+        quote = '"'
+        if '"' in value:
+            if "'" in value:
+                value = value.replace('"', "&quot;")
+            else:
+                quote = "'"
+        output += f" {name}={quote}{value}{quote}"
+
+    return output
+
+
+def _serialize(node: Element | str, parent: str, output: list[str], images: list[str]):
+    if isinstance(node, _Comment):
+        output.append(f"<!--{node}-->")
+    elif isinstance(node, _ProcessingInstruction):
+        output.append(f"<?{node}>")
+    elif isinstance(node, str):
+        output.append(node if parent in RAW_TEXT_ELEMENTS else _escape(node))
+    else:
+        tag, attributes, children = node
+        if tag == "img":
+            images.append(attributes.get("src", ""))
+
+        output.append(f"<{tag}{_attributes(tag, attributes)}")
+        if tag in VOID_ELEMENTS and not children:
+            output.append("/>")
+            return
+        output.append(">")
+        for child in children:
+            _serialize(child, tag, output, images)
+        output.append(f"</{tag}>")
+
+
+def _parse(body: str) -> Element | None:
+    parser = etree.HTMLParser(target=_TreeBuilder(), recover=True)
+    parser.feed(body)
+    return parser.close()
+
+
+def clean_part(title: str, id: int, body: str) -> CleanedPart:
+    """Clean a part's HTML in one pass, collecting its image URLs on the way.
+
+    Keeps the <p> tags of the part's body, splitting out images and line breaks, as `clean_tree` does. The output is identical to `str(clean_tree(title, id, body))`.
+
+    Args:
+        title (str): Part title.
+        id (int): Part ID.
+        body (str): Part HTML, as returned by Wattpad.
+
+    Returns:
+        CleanedPart: Chapter HTML and the URLs of its images.
+    """
+    if "<" in title or "&" in title:
+        # The title is parsed as markup by `clean_tree`, defer to it for its exact output.
+        from .parser import clean_tree, tree_image_urls
+
+        tree = clean_tree(title, id, body)
+        return CleanedPart(str(tree), tree_image_urls(tree))
+
+    output = [
+        f'\n<h1 class="chapter-title" id="{id}">{_escape(title)}</h1>\n<section class="chapter-body">'
+    ]
+    images: list[str] = []
+
+    for tag in _parse(body)[2]:  # type: ignore # Raises if there's no body, as `clean_tree` does
+        if isinstance(tag, str) or tag[0] != "p":
+            continue
+
+        attributes, children = tag[1], tag[2]
+        style = attributes.get("style")
+        for child in children:
+            name = None if isinstance(child, str) else child[0]
+
+            if name in TEXT_TAGS:
+                # Text is enclosed, the whole paragraph is kept with only its style.
+                output.append(
+                    f"<p{_attributes('p', {'style': style} if style else {})}>"
+                )
+                for node in children:
+                    _serialize(node, "p", output, images)
+                output.append("</p>")
+                break
+
+            elif name == "img":
+                img_attributes = {
+                    "height": child[1].get("data-original-height"),
+                    "width": child[1].get("data-original-width"),
+                    "src": child[1]["src"],
+                }
+                if style:
+                    img_attributes["style"] = style
+                # Not a void element to BeautifulSoup when created without a parser.
+                output.append(f"<img{_attributes('img', img_attributes)}></img>")
+                images.append(img_attributes["src"])  # type: ignore
+
+            elif name == "br":
+                output.append(
+                    f"<br{_attributes('br', {'style': style} if style else {})}/>"
+                )
+
+    output.append("</section>\n")
+    return CleanedPart("".join(output), images)
@@ -0,0 +1,183 @@
+from __future__ import annotations
+
+import asyncio
+from typing import TYPE_CHECKING, Optional
+
+from aiohttp import ClientSession, DummyCookieJar, TCPConnector
+from aiohttp_client_cache import CacheBackend
+from aiohttp_client_cache.session import CachedSession
+
+from .logs import logger
+
+if TYPE_CHECKING:
+    from .governor import OutboundGovernor
+
+
+class ClientManager:
+    """App-lifetime aiohttp sessions shared by every outbound request.
+
+    Wattpad API calls and image downloads use separate connection pools, so a story with many images can't starve metadata requests of connections. Sessions are shared between users, so cookie jars are disabled and cookies are passed per-request instead.
+
+    Args:
+        headers (dict): Headers sent with every request.
+        cache (Optional[CacheBackend]): Response cache for anonymous API requests.
+        api_limit (int): Total connections to API hosts.
+        api_limit_per_host (int): Connections per API host.
+        image_limit (int): Total connections to image hosts.
+        image_limit_per_host (int): Connections per image host.
+        keepalive_timeout (float): Seconds an idle connection is kept open.
+        dns_cache_ttl (int): Seconds a resolved address is reused.
+        governor (Optional[OutboundGovernor]): Paces requests that reach Wattpad, cache hits aren't counted.
+    """
+
+    def __init__(
+        self,
+        headers: dict,
+        cache: Optional[CacheBackend],
+        api_limit: int,
+        api_limit_per_host: int,
+        image_limit: int,
+        image_limit_per_host: int,
+        keepalive_timeout: float,
+        dns_cache_ttl: int,
+        governor: Optional[OutboundGovernor] = None,
+    ):
+        self.headers = headers
+        self.cache = cache
+
+        self._api_limits = (api_limit, api_limit_per_host)
+        self._image_limits = (image_limit, image_limit_per_host)
+        self._keepalive_timeout = keepalive_timeout
+        self._dns_cache_ttl = dns_cache_ttl
+        self.governor = governor
+
+        self._api_connector: Optional[TCPConnector] = None
+        self._image_connector: Optional[TCPConnector] = None
+
+        self._cached_api_session: Optional[ClientSession] = None
+        self._api_session: Optional[ClientSession] = None
+        self._image_session: Optional[ClientSession] = None
+
+        self._lock: Optional[asyncio.Lock] = None
+
+    def _connector(self, limit: int, limit_per_host: int) -> TCPConnector:
+        return TCPConnector(
+            limit=limit,
+            limit_per_host=limit_per_host,
+            keepalive_timeout=self._keepalive_timeout,
+            use_dns_cache=True,
+            ttl_dns_cache=self._dns_cache_ttl,
+        )
+
+    @property
+    def started(self) -> bool:
+        return self._api_session is not None
+
+    async def start(self):
+        """Open the connection pools. Safe to call more than once."""
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+
+        async with self._lock:
+            if self.started:
+                return
+
+            self._api_connector = self._connector(*self._api_limits)
+            self._image_connector = self._connector(*self._image_limits)
+
+            session_kwargs = {
+                "headers": self.headers,
+                "cookie_jar": DummyCookieJar(),
+                "connector_owner": False,
+            }
+
+            api_traces = [self.governor.trace_config()] if self.governor else []
+            image_traces = (
+                [self.governor.trace_config("images")] if self.governor else []
+            )
+
+            self._api_session = ClientSession(
+                connector=self._api_connector,
+                trace_configs=api_traces,
+                **session_kwargs,
+            )
+            # CachedSession falls back to an in-memory cache when cache=None, which would outlive a request here. Use the plain session instead.
+            self._cached_api_session = (
+                CachedSession(
+                    connector=self._api_connector,
+                    cache=self.cache,
+                    trace_configs=api_traces,
+                    **session_kwargs,
+                )
+                if self.cache
+                else self._api_session
+            )
+            self._image_session = ClientSession(
+                connector=self._image_connector,
+                trace_configs=image_traces,
+                **session_kwargs,
+            )
+
+            logger.info("Opened shared connection pools")
+
+    async def close(self):
+        """Close every session and connection pool."""
+        if not self.started:
+            return
+
+        sessions = {
+            id(session): session
+            for session in (
+                self._cached_api_session,
+                self._api_session,
+                self._image_session,
+            )
+            if session
+        }
+        for session in sessions.values():
+            await session.close()
+
+        for connector in (self._api_connector, self._image_connector):
+            if connector:
+                await connector.close()
+
+        self._cached_api_session = self._api_session = self._image_session = None
+        self._api_connector = self._image_connector = None
+
+        logger.info("Closed shared connection pools")
+
+    async def api(self, cached: bool = True) -> ClientSession:
+        """Session for wattpad.com requests. Requests carrying cookies must use `cached=False`."""
+        await self.start()
+        return self._cached_api_session if cached else self._api_session  # type: ignore
+
+    async def images(self) -> ClientSession:
+        """Session for image CDN requests."""
+        await self.start()
+        return self._image_session  # type: ignore
+
+    def metrics(self) -> dict:
+        """Connection pool usage, per pool."""
+        return {
+            "api": _connector_metrics(self._api_connector),
+            "images": _connector_metrics(self._image_connector),
+        }
+
+
+def _connector_metrics(connector: Optional[TCPConnector]) -> dict:
+    if connector is None or connector.closed:
+        return {"open": False}
+
+    # aiohttp doesn't expose pool usage publicly.
+    idle: dict[str, int] = {}
+    for key, connections in connector._conns.items():
+        idle[key.host] = idle.get(key.host, 0) + len(connections)
+
+    return {
+        "open": True,
+        "limit": connector.limit,
+        "limit_per_host": connector.limit_per_host,
+        "in_use": len(connector._acquired),
+        "idle": sum(idle.values()),
+        "idle_per_host": idle,
+    }
@@ -1,4 +1,6 @@
 from enum import Enum
+from os import cpu_count
+from typing import Literal
 
 from pydantic import field_validator, model_validator
 from pydantic_settings import BaseSettings
@@ -16,6 +18,118 @@ class Config(BaseSettings):
     CACHE_TYPE: CacheTypes = CacheTypes.file
     REDIS_CONNECTION_URL: str = ""
 
+    # Shared connection pools
+    API_POOL_LIMIT: int = 100
+    API_POOL_LIMIT_PER_HOST: int = 30
+    IMAGE_POOL_LIMIT: int = 100
+    IMAGE_POOL_LIMIT_PER_HOST: int = 30
+    POOL_KEEPALIVE_TIMEOUT: float = 30  # seconds
+    DNS_CACHE_TTL: int = 300  # seconds
+
+    # Private data: login sessions and authenticated responses, encrypted at rest
+    # Share between instances, unset uses a per-process secret
+    PRIVATE_CACHE_SECRET: str = ""
+    SESSION_CACHE: bool = True
+    SESSION_CACHE_TTL: int = 86400  # 1 day, or until the first login cookie expires
+    SESSION_CACHE_MAX_BYTES: int = 16 * 1024**2  # 16 MiB
+    # Cache story metadata and zips fetched with cookies, per user
+    PRIVATE_CACHE: bool = False
+    # 15 minutes, users can lose access to a story at any time
+    PRIVATE_CACHE_TTL: int = 900
+    PRIVATE_CACHE_MAX_BYTES: int = 256 * 1024**2  # 256 MiB
+
+    # Outbound rate limits, adapted to Wattpad's 429s
+    RATE_LIMIT_METADATA: float = 20  # requests/s, story and part metadata
+    RATE_LIMIT_STORYTEXT: float = 5  # requests/s, story zips and part text
+    RATE_LIMIT_IMAGES: float = 50  # requests/s
+    RATE_LIMIT_LOGIN: float = 1  # requests/s
+    # Lowest adapted rate, as a fraction of the limit
+    RATE_LIMIT_MIN_FRACTION: float = 0.05
+    # Requests/s regained per second of successful requests
+    RATE_LIMIT_INCREASE: float = 1
+    RATE_LIMIT_DECREASE: float = 0.5  # Rate multiplier on a 429
+    RATE_LIMIT_MAX_WAIT: float = 10  # seconds a request may queue before it's rejected
+    # Share limits between instances through Redis, needs CACHE_TYPE=redis
+    RATE_LIMIT_SHARED: bool = False
+
+    # Image downloads
+    IMAGE_FETCH_CONCURRENCY: int = 16  # Across all requests
+    IMAGE_FETCH_TIMEOUT: float = 20  # seconds
+    IMAGE_FETCH_RETRIES: int = 2
+    IMAGE_CACHE_MAX_BYTES: int = 1024**3  # 1 GiB
+    IMAGE_CACHE_TTL: int = 2592000  # 30 days, images rarely change once uploaded
+
+    # Image processing, for books with images
+    IMAGE_PROCESSING: bool = True
+    IMAGE_QUALITY: Literal["high", "balanced", "small"] = "balanced"
+    # EPUB only, PDF and MOBI always use JPEG
+    IMAGE_ENCODING: Literal["jpeg", "webp"] = "jpeg"
+    IMAGE_MAX_DIMENSION_EPUB: int = 1600
+    IMAGE_MAX_DIMENSION_PDF: int = 1800  # ~300 DPI across the page
+    IMAGE_MAX_DIMENSION_MOBI: int = 1200
+
+    # Story parts, cleaned
+    # Both produce the same output, lxml is faster
+    CLEANER: Literal["lxml", "bs4"] = "lxml"
+    PARSE_CHUNK_SIZE: int = 16  # Parts cleaned per build pool task
+    PIPELINE_DEPTH: int = 8  # Chapters fetched ahead of the book being written
+    PART_CACHE_MAX_BYTES: int = 512 * 1024**2  # 512 MiB
+    PART_CACHE_TTL: int = 2592000  # 30 days, entries are keyed by the part's modifyDate
+    # Above this many changed parts, the story zip is downloaded instead
+    PART_FETCH_MAX_REQUESTS: int = 10
+
+    # Rendered books
+    ARTIFACT_CACHE_MAX_BYTES: int = 2 * 1024**3  # 2 GiB
+    ARTIFACT_CACHE_TTL: int = 604800  # 7 days
+
+    # Book compilation
+    BUILD_WORKERS: int = cpu_count() or 1
+    # Builds running or waiting, before requests are rejected
+    BUILD_QUEUE_DEPTH: int = 32
+    BUILD_LIMIT_EPUB: int = 8
+    BUILD_LIMIT_PDF: int = 2
+    BUILD_LIMIT_MOBI: int = 2
+    BUILD_RETRY_AFTER: int = 30  # seconds
+    # Load PDF fonts and stylesheet when a worker starts, not on its first PDF
+    BUILD_WARM_PDF: bool = True
+    # Longer PDFs are laid out this many chapters at a time and merged, bounding memory. 0 disables
+    PDF_CHUNK_CHAPTERS: int = 50
+    # ExifTool rewrites each PDF after rendering
+    PDF_METADATA_WRITER: Literal["weasyprint", "exiftool"] = "weasyprint"
+    EPUB_WRITER: Literal["stream", "ebooklib"] = "stream"
+    # worker keeps calibre running in each build worker
+    MOBI_CONVERTER: Literal["worker", "subprocess"] = "worker"
+    MOBI_CONVERT_TIMEOUT: float = 300  # seconds
+    MOBI_WORKER_MAX_JOBS: int = 50  # Conversions before a calibre worker is restarted
+
+    # Background jobs
+    JOB_WORKERS: int = 4  # Jobs building at once, per instance
+    # Jobs running or waiting, before submissions are rejected
+    JOB_QUEUE_DEPTH: int = 64
+    # Seconds job records and results are kept after the last update
+    JOB_TTL: int = 3600
+    # 1 GiB, books built with credentials or without caching
+    JOB_RESULT_MAX_BYTES: int = 1024**3
+
+    # Batch downloads, several books in one zip
+    BATCH_MAX_BOOKS: int = 50  # Stories per request
+    # Books built at once, per request. Builds are also bounded by BUILD_LIMIT_*
+    BATCH_CONCURRENCY: int = 4
+
+    # Book delivery
+    DOWNLOAD_CHUNK_SIZE: int = 64 * 1024
+    # Larger books are spooled to disk while sending
+    DOWNLOAD_SPOOL_MAX_BYTES: int = 1024**2
+    DOWNLOAD_CLIENT_RATE_LIMIT: int = 0  # bytes/s per client, 0 disables
+    DOWNLOAD_GLOBAL_RATE_LIMIT: int = 0  # bytes/s across clients, 0 disables
+    DOWNLOAD_BURST: int = 1024**2
+    # Seconds books that can't be stored, e.g. built with cookies, are kept for resumed downloads
+    PRIVATE_BOOK_TTL: int = 300
+
+    # Story info, previewed before downloading
+    # Seconds clients may reuse it before revalidating with If-None-Match
+    STORY_INFO_MAX_AGE: int = 300
+
     @field_validator("USE_CACHE", mode="before")
     def validate_use_cache(cls, value):
         # Return default if value is an empty string
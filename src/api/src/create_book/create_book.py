@@ -1,25 +1,28 @@
 from __future__ import annotations
 
+import time
+from email.utils import parsedate_to_datetime
+from http.cookies import Morsel
 from io import BytesIO
 from typing import Optional
 
 import backoff
 from aiohttp import ClientResponseError
-from aiohttp_client_cache.session import CachedSession
 from eliot import start_action
 from pydantic import TypeAdapter
 
 from .exceptions import PartNotFoundError, StoryNotFoundError
 from .logs import logger
 from .models import Story
-from .vars import cache, headers
+from .private_cache import private_cache
+from .vars import clients
 
 story_ta = TypeAdapter(Story)
 
 # --- #
 
 
-async def fetch_cookies(username: str, password: str) -> dict:
+async def fetch_session(username: str, password: str) -> tuple[dict, Optional[float]]:
     # source: https://github.com/TheOnlyWayUp/WP-DM-Export/blob/dd4c7c51cb43f2108e0f63fc10a66cd24a740e4e/src/API/src/main.py#L25-L58
     """Retrieves authorization cookies from Wattpad by logging in with user creds.
 
@@ -32,98 +35,180 @@ async def fetch_cookies(username: str, password: str) -> dict:
         ValueError: No cookies returned.
 
     Returns:
-        dict: Authorization cookies.
+        tuple[dict, Optional[float]]: Authorization cookies, and when the first of them expires (Unix time), if any do.
     """
     with start_action(action_type="api_fetch_cookies"):
-        async with CachedSession(headers=headers, cache=None) as session:
-            async with session.post(
-                "https://www.wattpad.com/auth/login?nextUrl=%2F&_data=routes%2Fauth.login",
-                data={
-                    "username": username.lower(),
-                    "password": password,
-                },  # the username.lower() is for caching
-            ) as response:
-                if response.status != 204:
-                    raise ValueError("Not a 204.")
+        session = await clients.api(cached=False)
+        async with session.post(
+            "https://www.wattpad.com/auth/login?nextUrl=%2F&_data=routes%2Fauth.login",
+            data={
+                "username": username.lower(),
+                "password": password,
+            },  # the username.lower() is for caching
+        ) as response:
+            if response.status != 204:
+                raise ValueError("Not a 204.")
+
+            cookies = {
+                k: v.value
+                for k, v in response.cookies.items()  # Thanks https://stackoverflow.com/a/32281245
+            }
+
+            if not cookies:
+                raise ValueError("No cookies.")
+
+            expiries = [
+                expiry
+                for morsel in response.cookies.values()
+                if (expiry := _cookie_expiry(morsel)) is not None
+            ]
+
+            return cookies, min(expiries, default=None)
+
+
+async def fetch_cookies(username: str, password: str) -> dict:
+    """Retrieves authorization cookies from Wattpad by logging in with user creds. See `fetch_session`."""
+    cookies, _ = await fetch_session(username, password)
+    return cookies
+
 
-                cookies = {
-                    k: v.value
-                    for k, v in response.cookies.items()  # Thanks https://stackoverflow.com/a/32281245
-                }
+def _cookie_expiry(morsel: Morsel) -> Optional[float]:
+    """When a cookie expires (Unix time), from its Max-Age or Expires attribute."""
+    if max_age := morsel["max-age"]:
+        try:
+            return time.time() + int(max_age)
+        except ValueError:
+            pass
 
-                if not cookies:
-                    raise ValueError("No cookies.")
+    if expires := morsel["expires"]:
+        try:
+            return parsedate_to_datetime(expires).timestamp()
+        except (TypeError, ValueError):
+            pass
 
-                return cookies
+    return None
 
 
 # --- API Calls --- #
 
 
-@backoff.on_exception(backoff.expo, ClientResponseError, max_time=15)
+def _unauthorized(exception: ClientResponseError) -> bool:
+    # Retrying won't help, the cookies need refreshing.
+    return exception.status in (401, 403)
+
+
+@backoff.on_exception(
+    backoff.expo, ClientResponseError, max_time=15, giveup=_unauthorized
+)
 async def fetch_story_from_partId(
     part_id: int, cookies: Optional[dict] = None
 ) -> tuple[int, Story]:
     """Fetch Story metadata from a Part ID."""
     with start_action(action_type="api_fetch_storyFromPartId"):
-        async with CachedSession(
-            headers=headers, cache=None if cookies else cache
-        ) as session:  # Don't cache requests with Cookies.
-            async with session.get(
-                f"https://www.wattpad.com/api/v3/story_parts/{part_id}?fields=groupId,group(tags,id,title,createDate,modifyDate,language(name),description,completed,mature,url,isPaywalled,user(username,avatar,description),parts(id,title),cover,copyright)"
-            ) as response:
-                body = await response.json()
-
-                if response.status == 400:
-                    match body.get("error_code"):
-                        case 1020:  # "Story part not found"
-                            logger.info(f"{part_id=} not found on Wattpad, returning.")
-                            raise PartNotFoundError()
-
-                response.raise_for_status()
+        session = await clients.api(
+            cached=not cookies
+        )  # Don't cache requests with Cookies.
+        async with session.get(
+            f"https://www.wattpad.com/api/v3/story_parts/{part_id}?fields=groupId,group(tags,id,title,createDate,modifyDate,language(name),description,completed,mature,url,isPaywalled,user(username,avatar,description),parts(id,title,modifyDate),cover,copyright)",
+            cookies=cookies,
+        ) as response:
+            body = await response.json()
+
+            if response.status == 400:
+                match body.get("error_code"):
+                    case 1020:  # "Story part not found"
+                        logger.info(f"{part_id=} not found on Wattpad, returning.")
+                        raise PartNotFoundError()
+
+            response.raise_for_status()
 
         return int(body["groupId"]), story_ta.validate_python(body["group"])
 
 
-@backoff.on_exception(backoff.expo, ClientResponseError, max_time=15)
+@backoff.on_exception(
+    backoff.expo, ClientResponseError, max_time=15, giveup=_unauthorized
+)
 async def fetch_story(story_id: int, cookies: Optional[dict] = None) -> Story:
-    """Fetch Story metadata from a Story ID."""
+    """Fetch Story metadata from a Story ID. Requests with cookies use the private cache, if enabled."""
     with start_action(action_type="api_fetch_story", story_id=story_id):
-        async with CachedSession(
-            headers=headers, cookies=cookies, cache=None if cookies else cache
-        ) as session:
-            async with session.get(
-                f"https://www.wattpad.com/api/v3/stories/{story_id}?fields=tags,id,title,createDate,modifyDate,language(name),description,completed,mature,url,isPaywalled,user(username,avatar,description),parts(id,title),cover,copyright"
-            ) as response:
-                body = await response.json()
+        if cookies and private_cache:
+            if data := await private_cache.get(cookies, "story", story_id):
+                return story_ta.validate_json(data)
+
+        session = await clients.api(cached=not cookies)
+        async with session.get(
+            f"https://www.wattpad.com/api/v3/stories/{story_id}?fields=tags,id,title,createDate,modifyDate,language(name),description,completed,mature,url,isPaywalled,user(username,avatar,description),parts(id,title,modifyDate),cover,copyright",
+            cookies=cookies,
+        ) as response:
+            body = await response.json()
+
+            if response.status == 400:
+                match body.get("error_code"):
+                    case 1017:  # "Story not found"
+                        logger.info(f"{story_id=} not found on Wattpad, returning.")
+                        raise StoryNotFoundError()
 
-                if response.status == 400:
-                    match body.get("error_code"):
-                        case 1017:  # "Story not found"
-                            logger.info(f"{story_id=} not found on Wattpad, returning.")
-                            raise StoryNotFoundError()
+            response.raise_for_status()
 
-                response.raise_for_status()
+        story = story_ta.validate_python(body)
+        if cookies and private_cache:
+            await private_cache.set(
+                cookies, "story", story_id, value=story_ta.dump_json(story)
+            )
 
-        return story_ta.validate_python(body)
+        return story
 
 
-@backoff.on_exception(backoff.expo, ClientResponseError, max_time=15)
+@backoff.on_exception(
+    backoff.expo, ClientResponseError, max_time=15, giveup=_unauthorized
+)
 async def fetch_story_content_zip(
-    story_id: int, cookies: Optional[dict] = None
+    story_id: int,
+    cookies: Optional[dict] = None,
+    modify_date: str = "",
+    cached: bool = True,
 ) -> BytesIO:
-    """BytesIO Stream of an Archive of Part Contents for a Story."""
+    """BytesIO Stream of an Archive of Part Contents for a Story.
+
+    Requests with cookies use the private cache, if enabled. Entries are keyed by the story's `modifyDate`, when given, so an edited story is fetched again.
+
+    Anonymous requests use the response cache unless `cached` is False, which callers keeping their own cache of the content should pass. A cached response can predate the story's last edit.
+    """
     with start_action(action_type="api_fetch_storyZip", story_id=story_id):
-        async with CachedSession(
-            headers=headers,
+        if cookies and private_cache:
+            if data := await private_cache.get(cookies, "zip", story_id, modify_date):
+                return BytesIO(data)
+
+        session = await clients.api(cached=cached and not cookies)
+        async with session.get(
+            f"https://www.wattpad.com/apiv2/?m=storytext&group_id={story_id}&output=zip",
             cookies=cookies,
-            cache=None if cookies else cache,
-        ) as session:
-            async with session.get(
-                f"https://www.wattpad.com/apiv2/?m=storytext&group_id={story_id}&output=zip"
-            ) as response:
-                response.raise_for_status()
+        ) as response:
+            response.raise_for_status()
 
-                bytes_stream = BytesIO(await response.read())
+            bytes_stream = BytesIO(await response.read())
+
+        if cookies and private_cache:
+            await private_cache.set(
+                cookies, "zip", story_id, modify_date, value=bytes_stream.getvalue()
+            )
 
         return bytes_stream
+
+
+@backoff.on_exception(
+    backoff.expo, ClientResponseError, max_time=15, giveup=_unauthorized
+)
+async def fetch_part_content(
+    part_id: int, cookies: Optional[dict] = None, cached: bool = True
+) -> str:
+    """HTML Content of a single Part. See `fetch_story_content_zip` for `cached`."""
+    with start_action(action_type="api_fetch_partContent", part_id=part_id):
+        session = await clients.api(cached=cached and not cookies)
+        async with session.get(
+            f"https://www.wattpad.com/apiv2/?m=storytext&id={part_id}",
+            cookies=cookies,
+        ) as response:
+            response.raise_for_status()
+
+            return await response.text()
@@ -0,0 +1,40 @@
+import hmac
+from base64 import urlsafe_b64encode
+from hashlib import sha256
+from secrets import token_bytes
+
+from cryptography.fernet import Fernet, InvalidToken
+
+from .logs import logger
+from .vars import config
+
+if config.PRIVATE_CACHE_SECRET:
+    _secret = config.PRIVATE_CACHE_SECRET.encode()
+else:
+    # Private cache entries can't outlive this process, or be shared between instances.
+    _secret = token_bytes(32)
+    logger.info("PRIVATE_CACHE_SECRET is unset, using a per-process secret")
+
+
+def private_key(*identity: str) -> str:
+    """Salted hash naming private data, e.g. a user's cache entries, without revealing `identity`."""
+    return hmac.new(
+        _secret, "\0".join(("name", *identity)).encode(), sha256
+    ).hexdigest()
+
+
+def private_cipher(*identity: str) -> Fernet:
+    """Cipher for data belonging to `identity`, e.g. credentials.
+
+    Keys are derived from the secret and `identity`, so stored data can only be read by someone who has both.
+    """
+    key = hmac.new(_secret, "\0".join(("cipher", *identity)).encode(), sha256).digest()
+    return Fernet(urlsafe_b64encode(key))
+
+
+def decrypt(cipher: Fernet, token: bytes) -> bytes | None:
+    """Decrypt `token`, or None if it was encrypted with another key or tampered with."""
+    try:
+        return cipher.decrypt(token)
+    except InvalidToken:
+        return None
@@ -10,3 +10,26 @@ class StoryNotFoundError(WattpadError):
 
 class PartNotFoundError(StoryNotFoundError):
     ...
+
+
+class BuildQueueFullError(Exception):
+    """Too many books are queued for building. Retry after `retry_after` seconds."""
+
+    def __init__(self, retry_after: int):
+        super().__init__(f"Build queue is full, retry after {retry_after}s.")
+        self.retry_after = retry_after
+
+
+class RateLimitedError(Exception):
+    """Wattpad is rate limiting this endpoint for longer than a request may wait. Retry after `retry_after` seconds."""
+
+    def __init__(self, endpoint: str, retry_after: int):
+        super().__init__(
+            f"Requests to {endpoint} are rate limited, retry after {retry_after}s."
+        )
+        self.endpoint = endpoint
+        self.retry_after = retry_after
+
+
+class MissingCoverError(Exception):
+    """The story's cover, or the author's avatar for PDFs, couldn't be downloaded, so the book can't be built."""
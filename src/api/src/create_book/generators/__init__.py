@@ -1,5 +1,6 @@
 # ruff: noqa: F401
 
 from .epub import EPUBGenerator
+from .epub_stream import EPUBStreamWriter
 from .mobi import MOBIGenerator
-from .pdf import PDFGenerator
+from .pdf import PDFGenerator, pdf_exiftool, pdf_resources
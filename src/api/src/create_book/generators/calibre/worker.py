@@ -0,0 +1,45 @@
+"""Long-lived EPUB to MOBI converter, run with calibre's interpreter: `calibre-debug worker.py`.
+
+Reads one JSON job per line from stdin, `{"id": ..., "input": ..., "output": ...}`, and answers each with `{"id": ..., "ok": ..., "error": ...}` on stdout. Calibre's own output goes to stderr. Exits when stdin closes.
+
+Not imported by the API, calibre's modules are only available to calibre's interpreter. Kept in its own directory, as the script's directory is put on sys.path and generators/types.py would shadow the standard library.
+"""
+
+import json
+import os
+import sys
+import traceback
+
+from calibre.ebooks.conversion.cli import main as convert  # type: ignore
+
+
+def serve():
+    # Conversions print progress, keep stdout for answers. fd 1 is pointed at stderr too, so output written natively or by child processes can't reach the answers pipe.
+    answers = os.fdopen(os.dup(sys.stdout.fileno()), "w")
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+    sys.stdout = sys.stderr
+
+    def answer(**fields):
+        answers.write(json.dumps(fields) + "\n")
+        answers.flush()
+
+    answer(ready=True)
+
+    for line in sys.stdin:
+        job = json.loads(line)
+        try:
+            status = convert(["ebook-convert", job["input"], job["output"]])
+        except BaseException as exception:  # Option errors raise SystemExit
+            if isinstance(exception, KeyboardInterrupt):
+                raise
+            answer(id=job["id"], ok=False, error=traceback.format_exc(limit=5))
+        else:
+            answer(
+                id=job["id"],
+                ok=not status,
+                error=None if not status else f"ebook-convert exited with {status}",
+            )
+
+
+if __name__ == "__main__":
+    serve()
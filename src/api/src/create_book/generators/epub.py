@@ -6,19 +6,103 @@ from re import sub
 
 from ..logs import logger
 from ..models import Story
+from ..utils import IMAGE_EXTENSIONS, sniff_media_type
 from .types import AbstractGenerator
 
 
+def get_language_code(story: Story) -> str:
+    """Get a valid ISO language code with fallback handling."""
+    # Language name to ISO 639-1 code mapping
+    language_map = {
+        "English": "en",
+        "Spanish": "es",
+        "French": "fr",
+        "German": "de",
+        "Italian": "it",
+        "Portuguese": "pt",
+        "Russian": "ru",
+        "Chinese": "zh",
+        "Japanese": "ja",
+        "Korean": "ko",
+        "Arabic": "ar",
+        "Hindi": "hi",
+        "Dutch": "nl",
+        "Swedish": "sv",
+        "Norwegian": "no",
+        "Danish": "da",
+        "Finnish": "fi",
+        "Polish": "pl",
+        "Czech": "cs",
+        "Hungarian": "hu",
+        "Romanian": "ro",
+        "Bulgarian": "bg",
+        "Croatian": "hr",
+        "Serbian": "sr",
+        "Slovak": "sk",
+        "Slovenian": "sl",
+        "Estonian": "et",
+        "Latvian": "lv",
+        "Lithuanian": "lt",
+        "Greek": "el",
+        "Turkish": "tr",
+        "Hebrew": "he",
+        "Thai": "th",
+        "Vietnamese": "vi",
+        "Indonesian": "id",
+        "Malay": "ms",
+        "Tagalog": "tl",
+        "Filipino": "fil",
+        "Ukrainian": "uk",
+        "Belarusian": "be",
+        "Macedonian": "mk",
+        "Albanian": "sq",
+        "Maltese": "mt",
+        "Icelandic": "is",
+        "Irish": "ga",
+        "Welsh": "cy",
+        "Basque": "eu",
+        "Catalan": "ca",
+        "Galician": "gl",
+    }
+
+    # Get language from story metadata
+    language = story.get("language", {}).get("name", "")
+    logger.info(f"Language from API: {repr(language)}")
+
+    # Handle empty, None, or invalid language
+    if not language or language.strip() == "":
+        logger.warning("Language field is empty or missing, defaulting to 'en'")
+        return "en"
+
+    # Clean the language string
+    language = language.strip()
+
+    # Check if it's already a valid ISO code (2-3 characters)
+    if len(language) in [2, 3] and language.isalpha():
+        logger.info(f"Using language code as-is: {language}")
+        return language.lower()
+
+    # Try to map language name to ISO code
+    mapped_language = language_map.get(language, language)
+    if mapped_language != language:
+        logger.info(f"Mapped '{language}' to '{mapped_language}'")
+        return mapped_language
+
+    # If we can't map it, log warning and default to English
+    logger.warning(f"Unknown language '{language}', defaulting to 'en'")
+    return "en"
+
+
 class EPUBGenerator(AbstractGenerator):
     def __init__(
         self,
         metadata: Story,
-        part_trees: list[BeautifulSoup],
+        parts: list[str],
         cover: bytes,
         images: list[list[bytes | None]],
     ):
         self.story = metadata
-        self.parts = part_trees
+        self.parts = parts
         self.cover = cover
         self.images = images
 
@@ -26,85 +110,7 @@ class EPUBGenerator(AbstractGenerator):
 
     def _get_valid_language_code(self) -> str:
         """Get a valid ISO language code with fallback handling."""
-        # Language name to ISO 639-1 code mapping
-        language_map = {
-            "English": "en",
-            "Spanish": "es", 
-            "French": "fr",
-            "German": "de",
-            "Italian": "it",
-            "Portuguese": "pt",
-            "Russian": "ru",
-            "Chinese": "zh",
-            "Japanese": "ja",
-            "Korean": "ko",
-            "Arabic": "ar",
-            "Hindi": "hi",
-            "Dutch": "nl",
-            "Swedish": "sv",
-            "Norwegian": "no",
-            "Danish": "da",
-            "Finnish": "fi",
-            "Polish": "pl",
-            "Czech": "cs",
-            "Hungarian": "hu",
-            "Romanian": "ro",
-            "Bulgarian": "bg",
-            "Croatian": "hr",
-            "Serbian": "sr",
-            "Slovak": "sk",
-            "Slovenian": "sl",
-            "Estonian": "et",
-            "Latvian": "lv",
-            "Lithuanian": "lt",
-            "Greek": "el",
-            "Turkish": "tr",
-            "Hebrew": "he",
-            "Thai": "th",
-            "Vietnamese": "vi",
-            "Indonesian": "id",
-            "Malay": "ms",
-            "Tagalog": "tl",
-            "Filipino": "fil",
-            "Ukrainian": "uk",
-            "Belarusian": "be",
-            "Macedonian": "mk",
-            "Albanian": "sq",
-            "Maltese": "mt",
-            "Icelandic": "is",
-            "Irish": "ga",
-            "Welsh": "cy",
-            "Basque": "eu",
-            "Catalan": "ca",
-            "Galician": "gl"
-        }
-        
-        # Get language from story metadata
-        language = self.story.get("language", {}).get("name", "")
-        logger.info(f"Language from API: {repr(language)}")
-        
-        # Handle empty, None, or invalid language
-        if not language or language.strip() == "":
-            logger.warning("Language field is empty or missing, defaulting to 'en'")
-            return "en"
-        
-        # Clean the language string
-        language = language.strip()
-        
-        # Check if it's already a valid ISO code (2-3 characters)
-        if len(language) in [2, 3] and language.isalpha():
-            logger.info(f"Using language code as-is: {language}")
-            return language.lower()
-        
-        # Try to map language name to ISO code
-        mapped_language = language_map.get(language, language)
-        if mapped_language != language:
-            logger.info(f"Mapped '{language}' to '{mapped_language}'")
-            return mapped_language
-        
-        # If we can't map it, log warning and default to English
-        logger.warning(f"Unknown language '{language}', defaulting to 'en'")
-        return "en"
+        return get_language_code(self.story)
 
     def add_metadata(self):
         """Add metadata to epub."""
@@ -148,7 +154,8 @@ class EPUBGenerator(AbstractGenerator):
         """Add chapters to epub, replacing references to image urls to static image paths if images are provided during initialization."""
         chapters = []
 
-        for idx, (part, tree) in enumerate(zip(self.story["parts"], self.parts)):
+        for idx, (part, html) in enumerate(zip(self.story["parts"], self.parts)):
+            tree = BeautifulSoup(html, features="html.parser")
             chapter = epub.EpubHtml(
                 title=sub(r'[\x00-\x1F\x7F]', '', part["title"]), file_name=f"{idx}_{part['id']}.xhtml" # Removes control characters from chapter title
             )
@@ -157,9 +164,13 @@ class EPUBGenerator(AbstractGenerator):
                 for img_idx, (img_data, img_tag) in enumerate(
                     zip(self.images[idx], tree.find_all("img"))
                 ):
-                    path = f"static/{idx}_{part['id']}/{img_idx}.jpeg"
+                    if not img_data:
+                        continue
+
+                    media_type = sniff_media_type(img_data) or "image/jpeg"
+                    path = f"static/{idx}_{part['id']}/{img_idx}.{IMAGE_EXTENSIONS[media_type]}"
                     img = epub.EpubImage(
-                        media_type="image/jpeg", content=img_data, file_name=path
+                        media_type=media_type, content=img_data, file_name=path
                     )
                     self.book.add_item(img)
 
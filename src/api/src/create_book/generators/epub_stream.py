@@ -0,0 +1,206 @@
+from re import sub
+from typing import BinaryIO
+from xml.sax.saxutils import escape, quoteattr
+from zipfile import ZIP_DEFLATED, ZIP_STORED, ZipFile, ZipInfo
+
+from lxml import etree
+from lxml.html import fragment_fromstring
+
+from ..models import Part, Story
+from ..utils import IMAGE_EXTENSIONS, sniff_media_type
+from .epub import get_language_code
+
+CONTAINER = """<?xml version="1.0" encoding="utf-8"?>
+<container xmlns="urn:oasis:names:tc:opendocument:xmlns:container" version="1.0">
+  <rootfiles>
+    <rootfile media-type="application/oebps-package+xml" full-path="EPUB/content.opf"/>
+  </rootfiles>
+</container>
+"""
+
+XHTML = """<?xml version='1.0' encoding='utf-8'?>
+<!DOCTYPE html>
+<html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops" lang="{language}" xml:lang="{language}">
+  <head>
+    <title>{title}</title>
+  </head>
+  <body>{body}</body>
+</html>
+"""
+
+
+class EPUBStreamWriter:
+    """Write an EPUB's OCF container incrementally, as chapters are produced.
+
+    Chapters and their images are compressed into `output` as soon as they're added, so only the chapter being written is held in memory. The package document, navigation document and NCX need the complete manifest, so they're written last by `close`; only the mimetype has to come first in the archive.
+
+    Args:
+        metadata (Story): Story Metadata.
+        output (BinaryIO): Writable file object. Doesn't need to be seekable.
+    """
+
+    def __init__(self, metadata: Story, output: BinaryIO):
+        self.story = metadata
+        self.language = get_language_code(metadata)
+
+        self.zip = ZipFile(output, "w", compression=ZIP_DEFLATED)
+
+        mimetype = ZipInfo("mimetype")
+        mimetype.compress_type = ZIP_STORED  # Must be stored, and first
+        self.zip.writestr(mimetype, "application/epub+zip")
+        self.zip.writestr("META-INF/container.xml", CONTAINER)
+
+        # (id, href, media type, properties)
+        self.manifest: list[tuple[str, str, str, str]] = []
+        # (id, href, title)
+        self.chapters: list[tuple[str, str, str]] = []
+        self.has_cover = False
+
+    def _write(
+        self,
+        href: str,
+        data: bytes | str,
+        media_type: str,
+        properties: str = "",
+        id: str | None = None,
+    ) -> str:
+        """Add a file to the archive and manifest, returning its manifest id."""
+        id = id or f"item-{len(self.manifest)}"
+        self.zip.writestr(f"EPUB/{href}", data)
+        self.manifest.append((id, href, media_type, properties))
+        return id
+
+    def add_cover(self, cover: bytes):
+        media_type = sniff_media_type(cover) or "image/jpeg"
+        href = f"cover.{IMAGE_EXTENSIONS[media_type]}"
+
+        self._write(href, cover, media_type, "cover-image", id="cover-img")
+        self._write(
+            "cover.xhtml",
+            XHTML.format(
+                language=self.language,
+                title="Cover",
+                body=f'<img src="{href}" alt="Cover"/>',
+            ),
+            "application/xhtml+xml",
+            id="cover",
+        )
+        self.has_cover = True
+
+    def add_chapter(self, idx: int, part: Part, html: str, images: list[bytes | None]):
+        """Write a chapter and its images, replacing image URLs with their paths in the archive.
+
+        Args:
+            idx (int): Position of the chapter in the book.
+            part (Part): Part metadata.
+            html (str): Cleaned part HTML.
+            images (list[bytes | None]): Image data, aligned with the <img> tags in `html`. Empty if images weren't downloaded.
+        """
+        # Removes control characters from chapter title
+        title = sub(r"[\x00-\x1F\x7F]", "", part["title"])
+        href = f"{idx}_{part['id']}.xhtml"
+
+        body = fragment_fromstring(html, create_parent="body")
+        for img_idx, (img_data, img_tag) in enumerate(zip(images, body.iter("img"))):
+            if not img_data:
+                continue
+
+            media_type = sniff_media_type(img_data) or "image/jpeg"
+            path = f"static/{idx}_{part['id']}/{img_idx}.{IMAGE_EXTENSIONS[media_type]}"
+            self._write(path, img_data, media_type)
+            img_tag.set("src", path)
+
+        content = escape(body.text or "") + "".join(
+            etree.tostring(child, method="xml", encoding="unicode") for child in body
+        )
+        id = self._write(
+            href,
+            XHTML.format(language=self.language, title=escape(title), body=content),
+            "application/xhtml+xml",
+        )
+        self.chapters.append((id, href, title))
+
+    def _nav(self) -> str:
+        items = "".join(
+            f"\n        <li><a href={quoteattr(href)}>{escape(title)}</a></li>"
+            for _, href, title in self.chapters
+        )
+        return XHTML.format(
+            language=self.language,
+            title=escape(self.story["title"]),
+            body=f'\n    <nav epub:type="toc" id="toc" role="doc-toc">\n      <h2>{escape(self.story["title"])}</h2>\n      <ol>{items}\n      </ol>\n    </nav>\n  ',
+        )
+
+    def _ncx(self) -> str:
+        points = "".join(
+            f"""
+    <navPoint id="nav-{idx}" playOrder="{idx + 1}">
+      <navLabel><text>{escape(title)}</text></navLabel>
+      <content src={quoteattr(href)}/>
+    </navPoint>"""
+            for idx, (_, href, title) in enumerate(self.chapters)
+        )
+        return f"""<?xml version='1.0' encoding='utf-8'?>
+<ncx xmlns="http://www.daisy.org/z3986/2005/ncx/" version="2005-1">
+  <head>
+    <meta name="dtb:uid" content="wattpad-{escape(str(self.story["id"]))}"/>
+  </head>
+  <docTitle><text>{escape(self.story["title"])}</text></docTitle>
+  <navMap>{points}
+  </navMap>
+</ncx>
+"""
+
+    def _opf(self) -> str:
+        story = self.story
+
+        metas = "".join(
+            f"\n    <meta name={quoteattr(name)} content={quoteattr(content)}/>"
+            for name, content in {
+                "tags": ", ".join(story["tags"]),
+                "mature": str(int(story["mature"])),
+                "completed": str(int(story["completed"])),
+            }.items()
+        )
+        if self.has_cover:
+            metas += '\n    <meta name="cover" content="cover-img"/>'
+
+        manifest = "".join(
+            f'\n    <item id="{id}" href={quoteattr(href)} media-type="{media_type}"'
+            + (f' properties="{properties}"' if properties else "")
+            + "/>"
+            for id, href, media_type, properties in self.manifest
+        )
+
+        spine_ids = (["cover"] if self.has_cover else []) + ["nav"]
+        spine = "".join(
+            f'\n    <itemref idref="{id}"/>'
+            for id in spine_ids + [id for id, _, _ in self.chapters]
+        )
+
+        return f"""<?xml version='1.0' encoding='utf-8'?>
+<package xmlns="http://www.idpf.org/2007/opf" unique-identifier="id" version="3.0">
+  <metadata xmlns:dc="http://purl.org/dc/elements/1.1/" xmlns:opf="http://www.idpf.org/2007/opf">
+    <meta property="dcterms:modified">{escape(story["modifyDate"][:19])}Z</meta>
+    <dc:identifier id="id">wattpad-{escape(str(story["id"]))}</dc:identifier>
+    <dc:creator id="creator">{escape(story["user"]["username"])}</dc:creator>
+    <dc:title>{escape(story["title"])}</dc:title>
+    <dc:description>{escape(story["description"])}</dc:description>
+    <dc:date>{escape(story["createDate"])}</dc:date>
+    <dc:language>{escape(self.language)}</dc:language>{metas}
+  </metadata>
+  <manifest>
+    <item id="nav" href="nav.xhtml" media-type="application/xhtml+xml" properties="nav"/>
+    <item id="ncx" href="toc.ncx" media-type="application/x-dtbncx+xml"/>{manifest}
+  </manifest>
+  <spine toc="ncx">{spine}
+  </spine>
+</package>
+"""
+
+    def close(self):
+        """Write the navigation and package documents and finish the archive."""
+        self.zip.writestr("EPUB/nav.xhtml", self._nav())
+        self.zip.writestr("EPUB/toc.ncx", self._ncx())
+        self.zip.writestr("EPUB/content.opf", self._opf())
+        self.zip.close()
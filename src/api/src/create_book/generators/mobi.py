@@ -1,84 +1,210 @@
+import json
+import select
 import subprocess
 from io import BytesIO
 from pathlib import Path
-from tempfile import NamedTemporaryFile
-
-from bs4 import BeautifulSoup
+from tempfile import TemporaryDirectory
+from typing import Optional
 
 from ..logs import logger
 from ..models import Story
 from .epub import EPUBGenerator
 from .types import AbstractGenerator
 
+WORKER_PATH = Path(__file__).parent / "calibre" / "worker.py"
+# seconds, calibre imports its conversion plugins on startup
+WORKER_STARTUP_TIMEOUT = 60
+
+
+class CalibreWorker:
+    """A calibre interpreter kept running between conversions, see calibre/worker.py.
+
+    Starting calibre takes seconds, longer than converting most stories, so each build worker keeps one running. It's restarted after `max_jobs` conversions, bounding memory calibre leaks, and killed if a conversion takes longer than `timeout` seconds.
+
+    Args:
+        timeout (float): Seconds a conversion may take.
+        max_jobs (int): Conversions before the worker is restarted.
+    """
+
+    def __init__(self, timeout: float, max_jobs: int):
+        self.timeout = timeout
+        self.max_jobs = max_jobs
+
+        self.process: Optional[subprocess.Popen] = None
+        self.jobs = 0
+
+    def _start(self):
+        self.process = subprocess.Popen(
+            ["calibre-debug", str(WORKER_PATH)],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            text=True,
+        )
+        self.jobs = 0
+        self._read(WORKER_STARTUP_TIMEOUT)
+        logger.info(f"Started calibre worker {self.process.pid}")
+
+    def _read(self, timeout: float, id: Optional[int] = None) -> dict:
+        """Read the worker's next answer, the answer to job `id` if given. The worker is killed if it's out of sync.
+
+        Raises:
+            RuntimeError: The worker timed out, exited, or answered something else.
+        """
+        assert self.process and self.process.stdout
+
+        ready, _, _ = select.select([self.process.stdout], [], [], timeout)
+        line = self.process.stdout.readline() if ready else None
+        if not line:
+            self.close()
+            raise RuntimeError(
+                "Calibre worker timed out." if not ready else "Calibre worker exited."
+            )
+
+        try:
+            answer = json.loads(line)
+        except json.JSONDecodeError:
+            self.close()
+            raise RuntimeError("Calibre worker wrote something other than an answer.")
+
+        if id is not None and answer.get("id") != id:
+            self.close()
+            raise RuntimeError("Calibre worker answered out of turn.")
+
+        return answer
+
+    def convert(self, epub_path: str, mobi_path: str):
+        """Convert EPUB file to MOBI format.
+
+        Raises:
+            RuntimeError: The conversion failed or timed out.
+        """
+        if (
+            self.process is None
+            or self.process.poll() is not None
+            or self.jobs >= self.max_jobs
+        ):
+            self.close()
+            self._start()
+
+        assert self.process and self.process.stdin
+
+        self.jobs += 1
+        job = {"id": self.jobs, "input": epub_path, "output": mobi_path}
+        try:
+            self.process.stdin.write(json.dumps(job) + "\n")
+            self.process.stdin.flush()
+        except BrokenPipeError:
+            self.close()
+            raise RuntimeError("Calibre worker exited.")
+
+        answer = self._read(self.timeout, job["id"])
+        if not answer["ok"]:
+            raise RuntimeError(f"Failed to convert EPUB to MOBI: {answer['error']}")
+
+    def close(self):
+        if self.process is None:
+            return
+
+        if self.process.poll() is None:
+            self.process.kill()
+        self.process.wait()
+        self.process = None
+
+
+_calibre: Optional[CalibreWorker] = None
+
+
+def calibre_worker(timeout: float, max_jobs: int) -> CalibreWorker:
+    """This process's CalibreWorker, started on first use."""
+    global _calibre
+
+    if _calibre is None:
+        _calibre = CalibreWorker(timeout, max_jobs)
+
+    return _calibre
+
 
 class MOBIGenerator(AbstractGenerator):
     """Generates MOBI files by converting from EPUB format.
-    
+
     This generator first creates an EPUB file, then converts it to MOBI
-    using calibre's ebook-convert command-line tool.
+    using calibre, either in a long-lived worker (see CalibreWorker) or by
+    running the ebook-convert command-line tool.
     """
 
     def __init__(
         self,
         metadata: Story,
-        part_trees: list[BeautifulSoup],
+        parts: list[str],
         cover: bytes,
         images: list[list[bytes | None]],
+        converter: str = "worker",
+        timeout: float = 300,
+        max_jobs: int = 50,
     ):
+        """
+        Args:
+            converter (str): "worker" converts in this process's CalibreWorker, "subprocess" runs ebook-convert per book.
+            timeout (float): Seconds a conversion may take.
+            max_jobs (int): Conversions before a CalibreWorker is restarted.
+        """
         self.story = metadata
-        self.parts = part_trees
+        self.parts = parts
         self.cover = cover
         self.images = images
-        
+        self.converter = converter
+        self.timeout = timeout
+        self.max_jobs = max_jobs
+
         # Create the EPUB generator
-        self.epub_generator = EPUBGenerator(metadata, part_trees, cover, images)
-        
-        # This will be our temporary MOBI file
-        self.mobi_file: NamedTemporaryFile = NamedTemporaryFile(suffix=".mobi", delete=False)
+        self.epub_generator = EPUBGenerator(metadata, parts, cover, images)
+
+        self.mobi = b""
 
     def compile(self) -> bool:
         """Compile the book by first creating EPUB, then converting to MOBI.
-        
+
         Returns:
             bool: True if compilation successful.
         """
         # First compile the EPUB
         logger.info("Generating EPUB for MOBI conversion...")
         self.epub_generator.compile()
-        
-        # Get the EPUB bytes
-        epub_buffer = self.epub_generator.dump()
-        epub_buffer.seek(0)
-        
-        # Write EPUB to a temporary file
-        with NamedTemporaryFile(suffix=".epub", delete=False) as epub_file:
-            epub_file.write(epub_buffer.read())
-            epub_file_path = epub_file.name
-        
-        try:
-            # Convert EPUB to MOBI using calibre's ebook-convert
-            logger.info("Converting EPUB to MOBI using calibre...")
-            self._convert_epub_to_mobi(epub_file_path, self.mobi_file.name)
-            return True
-        except FileNotFoundError:
-            logger.error("Calibre's ebook-convert not found. Make sure calibre is installed.")
-            raise RuntimeError(
-                "MOBI generation requires calibre to be installed. "
-                "Please install calibre: https://calibre-ebook.com/download"
-            )
-        except subprocess.CalledProcessError as e:
-            logger.error(f"Failed to convert EPUB to MOBI: {e}")
-            raise RuntimeError(f"Failed to convert EPUB to MOBI: {e}")
-        finally:
-            # Clean up temporary EPUB file
+
+        # Both files are removed with the directory, whether or not conversion succeeds
+        with TemporaryDirectory(prefix="wpd-mobi-") as directory:
+            epub_file_path = str(Path(directory) / "book.epub")
+            mobi_file_path = str(Path(directory) / "book.mobi")
+            Path(epub_file_path).write_bytes(self.epub_generator.dump().getvalue())
+
             try:
-                Path(epub_file_path).unlink()
-            except Exception as e:
-                logger.warning(f"Could not delete temporary EPUB file: {e}")
+                logger.info("Converting EPUB to MOBI using calibre...")
+                if self.converter == "worker":
+                    calibre_worker(self.timeout, self.max_jobs).convert(
+                        epub_file_path, mobi_file_path
+                    )
+                else:
+                    self._convert_epub_to_mobi(epub_file_path, mobi_file_path)
+            except FileNotFoundError:
+                logger.error("Calibre not found. Make sure calibre is installed.")
+                raise RuntimeError(
+                    "MOBI generation requires calibre to be installed. "
+                    "Please install calibre: https://calibre-ebook.com/download"
+                )
+            except subprocess.CalledProcessError as e:
+                logger.error(f"Failed to convert EPUB to MOBI: {e}")
+                raise RuntimeError(f"Failed to convert EPUB to MOBI: {e}")
+            except subprocess.TimeoutExpired:
+                raise RuntimeError("Calibre timed out converting EPUB to MOBI.")
+
+            self.mobi = Path(mobi_file_path).read_bytes()
+
+        return True
 
     def _convert_epub_to_mobi(self, epub_path: str, mobi_path: str):
         """Convert EPUB file to MOBI format using calibre's ebook-convert.
-        
+
         Args:
             epub_path: Path to the source EPUB file
             mobi_path: Path where the MOBI file should be written
@@ -90,6 +216,7 @@ class MOBIGenerator(AbstractGenerator):
                 capture_output=True,
                 text=True,
                 check=True,
+                timeout=self.timeout,
             )
             logger.info(f"Successfully converted EPUB to MOBI: {result.stdout}")
         except FileNotFoundError:
@@ -100,6 +227,7 @@ class MOBIGenerator(AbstractGenerator):
                     capture_output=True,
                     text=True,
                     check=True,
+                    timeout=self.timeout,
                 )
                 logger.info(f"Successfully converted EPUB to MOBI: {result.stdout}")
             except FileNotFoundError:
@@ -108,25 +236,8 @@ class MOBIGenerator(AbstractGenerator):
 
     def dump(self) -> BytesIO:
         """Return the MOBI file as a BytesIO buffer.
-        
+
         Returns:
             BytesIO: Buffer containing the MOBI file data
         """
-        # Read the MOBI file content
-        self.mobi_file.seek(0)
-        mobi_content = self.mobi_file.read()
-        
-        # Create a BytesIO buffer
-        buffer = BytesIO(mobi_content)
-        
-        # Clean up the temporary file
-        self.mobi_file.close()
-        try:
-            Path(self.mobi_file.name).unlink()
-        except Exception as e:
-            logger.warning(f"Could not delete temporary MOBI file: {e}")
-        
-        buffer.seek(0)
-        return buffer
-
-
+        return BytesIO(self.mobi)
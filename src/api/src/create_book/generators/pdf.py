@@ -1,19 +1,33 @@
-from base64 import b64encode
+from datetime import datetime, timezone
+from hashlib import sha256
 from io import BytesIO
 from pathlib import Path
-from tempfile import NamedTemporaryFile, _TemporaryFileWrapper
+from tempfile import NamedTemporaryFile, TemporaryFile, _TemporaryFileWrapper
+from typing import IO, Optional
+from xml.sax.saxutils import escape
 
 from bs4 import BeautifulSoup
 from exiftool import ExifTool
 from jinja2 import Template
-from weasyprint import CSS, HTML
+from pydyf import PDF, Stream, String
+from pypdf import PdfWriter
+from pypdf.annotations import Link
+from pypdf.generic import DecodedStreamObject, NameObject, TextStringObject
+from weasyprint import CSS, HTML, default_url_fetcher
+from weasyprint.document import Document, DocumentMetadata
 from weasyprint.text.fonts import FontConfiguration
 
 from ..logs import logger
 from ..models import Story
+from ..utils import sniff_media_type
+from .epub import get_language_code
 from .types import AbstractGenerator
 
 DATA_PATH = Path(__file__).parent / "pdf"
+PX_TO_PT = 0.75  # WeasyPrint lays out in CSS pixels, PDFs measure in points
+IMAGE_SCHEME = "wpd-image:"
+PRODUCER = "Dhanush Rambhatla (TheOnlyWayUp - https://rambhat.la) and WattpadDownloader"
+TOC_PLACEHOLDER_PAGE = 8888  # As wide as any real page number, so the real table of contents fits the same pages
 ASSET_PATH = DATA_PATH / "assets"
 
 COPYRIGHT_DATA = {
@@ -83,127 +97,148 @@ with open(DATA_PATH / "book.html") as reader:
     TEMPLATE = reader.read()
 
 
+class PDFResources:
+    """Rendering state shared by every book: fonts, the parsed stylesheet, the compiled template and license images.
+
+    Loading fonts and parsing the stylesheet costs more than laying out a short story, so it's done once per process (see `pdf_resources`) and reused by every build.
+    """
+
+    def __init__(self):
+        self.font_config = FontConfiguration()
+        self.stylesheet = CSS(string=STYLESHEET, font_config=self.font_config)
+        self.template = Template(TEMPLATE)
+        self.licenses = {
+            id: data["asset"].read_bytes() if data["asset"] else b""
+            for id, data in COPYRIGHT_DATA.items()
+        }
+
+
+_resources: Optional[PDFResources] = None
+
+
+_exiftool: Optional[ExifTool] = None
+
+
+def pdf_exiftool() -> ExifTool:
+    """This process's ExifTool, kept running (`-stay_open`) between books."""
+    global _exiftool
+
+    if _exiftool is None:
+        # Custom configuration adds Completed and MatureContent tags.
+        _exiftool = ExifTool(config_file=DATA_PATH / "exiftool.config")
+    if not _exiftool.running:
+        _exiftool.run()
+
+    return _exiftool
+
+
+class PDFImages:
+    """A book's images, referenced from its HTML by short URLs and handed to WeasyPrint by `fetch`.
+
+    Embedding images as base64 data URIs inflates them by a third and makes WeasyPrint parse megabytes of attribute values. URLs are derived from the image's content, so repeated images share a URL and WeasyPrint decodes them once per document.
+    """
+
+    def __init__(self):
+        self.images: dict[str, tuple[bytes, str]] = {}
+
+    def add(self, data: bytes) -> str:
+        """Register an image, returning its URL."""
+        id = sha256(data).hexdigest()[:16]
+        if id not in self.images:
+            self.images[id] = (data, sniff_media_type(data) or "image/jpeg")
+        return f"{IMAGE_SCHEME}{id}"
+
+    def fetch(self, url: str, *args, **kwargs) -> dict:
+        """WeasyPrint `url_fetcher`. Other URLs, like the stylesheet's fonts, are fetched as usual."""
+        if url.startswith(IMAGE_SCHEME) and (
+            image := self.images.get(url.removeprefix(IMAGE_SCHEME))
+        ):
+            data, media_type = image
+            return {"string": data, "mime_type": media_type}
+
+        return default_url_fetcher(url, *args, **kwargs)
+
+
+def pdf_resources() -> PDFResources:
+    """This process's PDFResources, loaded on first use."""
+    global _resources
+
+    if _resources is None:
+        _resources = PDFResources()
+        logger.info("Loaded PDF fonts, stylesheet and template")
+
+    return _resources
+
+
 class PDFGenerator(AbstractGenerator):
     def __init__(
         self,
         metadata: Story,
-        part_trees: list[BeautifulSoup],
+        parts: list[str],
         cover: bytes,
         images: list[list[bytes | None]],
         author_image: bytes,
+        chunk_chapters: int = 0,
+        metadata_writer: str = "weasyprint",
     ):
+        """
+        Args:
+            chunk_chapters (int): Longer books are rendered this many chapters at a time, see `generate_chunked_pdf`. 0 renders every book as one document.
+            metadata_writer (str): "weasyprint" writes metadata while the PDF is written, "exiftool" rewrites the finished PDF with ExifTool.
+        """
         self.story = metadata
-        self.parts = part_trees
+        self.parts = parts
         self.cover = cover
         self.images = images
         self.author = author_image
+        self.chunk_chapters = chunk_chapters
+        self.metadata_writer = metadata_writer
 
         self.book: _TemporaryFileWrapper = NamedTemporaryFile(suffix=".pdf")
-        self.content = TEMPLATE
+        self.resources = pdf_resources()
+        self.assets = PDFImages()
+        self.content = ""
 
     def _get_valid_language_code(self) -> str:
         """Get a valid ISO language code with fallback handling."""
-        # Language name to ISO 639-1 code mapping
-        language_map = {
-            "English": "en",
-            "Spanish": "es", 
-            "French": "fr",
-            "German": "de",
-            "Italian": "it",
-            "Portuguese": "pt",
-            "Russian": "ru",
-            "Chinese": "zh",
-            "Japanese": "ja",
-            "Korean": "ko",
-            "Arabic": "ar",
-            "Hindi": "hi",
-            "Dutch": "nl",
-            "Swedish": "sv",
-            "Norwegian": "no",
-            "Danish": "da",
-            "Finnish": "fi",
-            "Polish": "pl",
-            "Czech": "cs",
-            "Hungarian": "hu",
-            "Romanian": "ro",
-            "Bulgarian": "bg",
-            "Croatian": "hr",
-            "Serbian": "sr",
-            "Slovak": "sk",
-            "Slovenian": "sl",
-            "Estonian": "et",
-            "Latvian": "lv",
-            "Lithuanian": "lt",
-            "Greek": "el",
-            "Turkish": "tr",
-            "Hebrew": "he",
-            "Thai": "th",
-            "Vietnamese": "vi",
-            "Indonesian": "id",
-            "Malay": "ms",
-            "Tagalog": "tl",
-            "Filipino": "fil",
-            "Ukrainian": "uk",
-            "Belarusian": "be",
-            "Macedonian": "mk",
-            "Albanian": "sq",
-            "Maltese": "mt",
-            "Icelandic": "is",
-            "Irish": "ga",
-            "Welsh": "cy",
-            "Basque": "eu",
-            "Catalan": "ca",
-            "Galician": "gl"
-        }
-        
-        # Get language from story metadata
-        language = self.story.get("language", {}).get("name", "")
-        logger.info(f"Language from API: {repr(language)}")
-        
-        # Handle empty, None, or invalid language
-        if not language or language.strip() == "":
-            logger.warning("Language field is empty or missing, defaulting to 'en'")
-            return "en"
-        
-        # Clean the language string
-        language = language.strip()
-        
-        # Check if it's already a valid ISO code (2-3 characters)
-        if len(language) in [2, 3] and language.isalpha():
-            logger.info(f"Using language code as-is: {language}")
-            return language.lower()
-        
-        # Try to map language name to ISO code
-        mapped_language = language_map.get(language, language)
-        if mapped_language != language:
-            logger.info(f"Mapped '{language}' to '{mapped_language}'")
-            return mapped_language
-        
-        # If we can't map it, log warning and default to English
-        logger.warning(f"Unknown language '{language}', defaulting to 'en'")
-        return "en"
+        return get_language_code(self.story)
 
-    def generate_chapters(self) -> dict[int, str]:
-        """Return a dictionary of part_ids to content trees, with image URLs replaced with base64 encoded images if provided during initialization."""
-        data: dict[int, str] = {}
-        for idx, (part, tree) in enumerate(zip(self.story["parts"], self.parts)):
-            if self.images:
-                for img_idx, (img_data, img_tag) in enumerate(
-                    zip(self.images[idx], tree.find_all("img"))
-                ):
-                    if not img_data:
-                        continue
+    def generate_chapter(self, idx: int) -> str:
+        """Return a part's content HTML, with image URLs pointing to the images provided during initialization, see `PDFImages`."""
+        tree = BeautifulSoup(self.parts[idx], features="html.parser")
+        if self.images:
+            for img_idx, (img_data, img_tag) in enumerate(
+                zip(self.images[idx], tree.find_all("img"))
+            ):
+                if not img_data:
+                    continue
 
-                    img_tag["src"] = (
-                        f"data:image/jpg;base64,{b64encode(img_data).decode()}"
-                    )
+                img_tag["src"] = self.assets.add(img_data)
 
-            data[part["id"]] = tree.prettify()
+        return tree.prettify()
 
-        return data
+    def generate_chapters(self) -> dict[int, str]:
+        """Return a dictionary of part_ids to content HTML, see `generate_chapter`."""
+        return {
+            part["id"]: self.generate_chapter(idx)
+            for idx, part in enumerate(self.story["parts"][: len(self.parts)])
+        }
 
-    def populate_template(self, parts: dict[int, str]):
-        """Populate HTML Template with Story data."""
+    def render_template(
+        self,
+        parts: dict[int, str],
+        front: bool = True,
+        back: bool = True,
+        toc: Optional[list[dict]] = None,
+    ) -> str:
+        """Render the HTML Template with Story data.
+
+        Args:
+            parts (dict[int, str]): Chapters to include, see `generate_chapters`.
+            front (bool): Include the cover, copyright notice and table of contents.
+            back (bool): Include the author page.
+            toc (Optional[list[dict]]): Table of contents entries with `id`, `number`, `title` and `page`. By default entries only have an `id`, and the rest is filled in during layout.
+        """
         copyright = COPYRIGHT_DATA[self.story["copyright"]]
         data = {
             "statement": copyright["statement"].format(
@@ -215,34 +250,229 @@ class PDFGenerator(AbstractGenerator):
             "printing": copyright["printing"],
             "book_id": self.story["id"],
             "book_title": self.story["title"],
-            "cover": f"data:image/jpg;base64,{b64encode(self.cover).decode()}",
+            "cover": self.assets.add(self.cover),
             "username": self.story["user"]["username"],
             "description": self.story["description"],
-            "avatar": b64encode(self.author).decode(),
+            "avatar": self.assets.add(self.author),
             "copyright": {
                 "data": (
-                    b64encode(copyright["asset"].read_bytes()).decode()
-                    if copyright["asset"]
+                    self.assets.add(license)
+                    if (license := self.resources.licenses[self.story["copyright"]])
                     else ""
                 ),
                 "name": copyright["name"],
             },
             "parts": parts,
+            "front": front,
+            "back": back,
+            "toc": toc if toc is not None else [{"id": id} for id in parts],
         }
 
-        self.content: str = Template(self.content).render(data)
+        return self.resources.template.render(data)
+
+    def populate_template(self, parts: dict[int, str]):
+        """Populate HTML Template with Story data."""
+        self.content = self.render_template(parts)
 
     def generate_pdf(self):
         """Generate and write the PDF to a temporary file (self.book)."""
-        font_config = FontConfiguration()
+        html_obj = HTML(string=self.content, url_fetcher=self.assets.fetch)
+        document = html_obj.render(
+            stylesheets=[self.resources.stylesheet],
+            font_config=self.resources.font_config,
+        )
+        if self.metadata_writer == "weasyprint":
+            self.set_metadata(document.metadata)
+        document.write_pdf(self.book.name, finisher=self._finish)
+
+    def _finish(self, document: Document, pdf: PDF):
+        # WeasyPrint names itself, and has no option to change it.
+        pdf.info["Producer"] = String(PRODUCER)
 
-        stylesheet_obj = CSS(string=STYLESHEET, font_config=font_config)
+        if self.metadata_writer == "weasyprint":
+            xmp = Stream(
+                [self.xmp_metadata()], {"Type": "/Metadata", "Subtype": "/XML"}
+            )
+            pdf.add_object(xmp)
+            pdf.catalog["Metadata"] = xmp.reference
 
-        html_obj = HTML(string=self.content)
-        html_obj.write_pdf(
-            self.book.name, stylesheets=[stylesheet_obj], font_config=font_config
+    def _render_chunk(
+        self, content: str, first_page: int, chapters_before: int
+    ) -> Document:
+        """Lay out part of the book, continuing the page and chapter counters from the chunks before it."""
+        counters = CSS(
+            string=f"html {{ counter-reset: h2-counter {chapters_before}; }}"
+            f"@page :first {{ counter-reset: page {first_page}; }}"
+        )
+        return HTML(string=content, url_fetcher=self.assets.fetch).render(
+            stylesheets=[self.resources.stylesheet, counters],
+            font_config=self.resources.font_config,
         )
 
+    def _toc(self, pages: dict[str, int]) -> list[dict]:
+        return [
+            {
+                "id": part["id"],
+                "number": number,
+                "title": part["title"],
+                "page": pages.get(str(part["id"]), TOC_PLACEHOLDER_PAGE),
+            }
+            for number, part in enumerate(self.story["parts"][: len(self.parts)], 1)
+        ]
+
+    def generate_chunked_pdf(self):
+        """Generate the PDF a few chapters at a time, merging the pieces into self.book.
+
+        The front matter, every `chunk_chapters` chapters and the author page are laid out as separate documents, so peak memory is bounded by the largest chunk rather than the whole book. Page and chapter counters carry over between chunks, and chunks are padded to an even page count so each starts on a right-hand page, as it would in one document.
+
+        The table of contents is laid out first with placeholder page numbers to find its length, and again once every chapter's page is known. Its links point into other chunks, so they're added to the merged PDF.
+        """
+        ids = [part["id"] for part in self.story["parts"][: len(self.parts)]]
+        placeholder = self._render_chunk(
+            self.render_template({}, back=False, toc=self._toc({})), 1, 0
+        )
+        front_pages = _even(len(placeholder.pages))
+        del placeholder
+
+        while True:
+            # PDF and page count, padding included
+            chunks: list[tuple[IO[bytes], int]] = []
+            pages: dict[str, int] = {}  # Anchor (part ID) to page number
+            page = front_pages + 1
+
+            for start in range(0, len(ids), self.chunk_chapters):
+                chapters = {
+                    ids[idx]: self.generate_chapter(idx)
+                    for idx in range(start, min(start + self.chunk_chapters, len(ids)))
+                }
+                document = self._render_chunk(
+                    self.render_template(chapters, front=False, back=False),
+                    page,
+                    start,
+                )
+                for offset, document_page in enumerate(document.pages):
+                    for anchor in document_page.anchors:
+                        pages.setdefault(anchor, page + offset)
+
+                chunks.append((_write_chunk(document), _even(len(document.pages))))
+                page += chunks[-1][1]
+
+            document = self._render_chunk(
+                self.render_template({}, front=False), page, len(ids)
+            )
+            chunks.append((_write_chunk(document), len(document.pages)))
+
+            front = self._render_chunk(
+                self.render_template({}, back=False, toc=self._toc(pages)), 1, 0
+            )
+            if len(front.pages) <= front_pages:
+                break
+
+            # The table of contents outgrew its placeholder, every chapter moves.
+            logger.warning("Table of contents grew, rendering chunks again")
+            front_pages = _even(len(front.pages))
+            for chunk, _ in chunks:
+                chunk.close()
+
+        toc_links = [
+            (index, target, rectangle)
+            for index, document_page in enumerate(front.pages)
+            for link_type, target, rectangle, _ in document_page.links
+            if link_type == "internal" and target in pages
+        ]
+        for document_page in front.pages:
+            # Their targets are in other chunks, they're added once merged.
+            document_page.links = [
+                link for link in document_page.links if link[0] != "internal"
+            ]
+        chunks.insert(0, (_write_chunk(front), front_pages))
+
+        writer = PdfWriter()
+        for chunk, page_count in chunks:
+            start = len(writer.pages)
+            writer.append(chunk)  # Outline (bookmarks) included
+            chunk.close()
+            while len(writer.pages) < start + page_count:
+                writer.add_blank_page()
+
+        for index, target, (x, y, width, height) in toc_links:
+            page_height = float(writer.pages[index].mediabox.height)
+            writer.add_annotation(
+                index,
+                Link(
+                    rect=(
+                        x * PX_TO_PT,
+                        page_height - (y + height) * PX_TO_PT,
+                        (x + width) * PX_TO_PT,
+                        page_height - y * PX_TO_PT,
+                    ),
+                    target_page_index=pages[target] - 1,
+                ),
+            )
+
+        if self.metadata_writer == "weasyprint":
+            writer.add_metadata(
+                {
+                    "/Title": self.story["title"],
+                    "/Author": self.story["user"]["username"],
+                    "/Subject": self.story["description"].strip(),
+                    "/Keywords": ", ".join(self.story["tags"]),
+                    "/CreationDate": _pdf_date(self.story["createDate"]),
+                    "/ModDate": _pdf_date(self.story["modifyDate"]),
+                    "/Producer": PRODUCER,
+                }
+            )
+            writer.root_object[NameObject("/Lang")] = TextStringObject(
+                self._get_valid_language_code()
+            )
+
+            xmp = DecodedStreamObject()
+            xmp.set_data(self.xmp_metadata())
+            xmp.update(
+                {
+                    NameObject("/Type"): NameObject("/Metadata"),
+                    NameObject("/Subtype"): NameObject("/XML"),
+                }
+            )
+            writer.root_object[NameObject("/Metadata")] = writer._add_object(xmp)
+
+        writer.write(self.book.name)
+
+    def custom_metadata(self) -> dict[str, str]:
+        """Metadata without a standard PDF field, written as the custom XMP tags defined in exiftool.config."""
+        return {
+            "Completed": str(self.story["completed"]),
+            "MatureContent": str(self.story["mature"]),
+        }
+
+    def xmp_metadata(self) -> bytes:
+        """XMP packet holding `custom_metadata`, as ExifTool writes it."""
+        tags = "".join(
+            f"<xmp:{key}>{escape(value)}</xmp:{key}>"
+            for key, value in self.custom_metadata().items()
+        )
+        return (
+            '<?xpacket begin="\ufeff" id="W5M0MpCehiHzreSzNTczkc9d"?>'
+            '<x:xmpmeta xmlns:x="adobe:ns:meta/">'
+            '<rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#">'
+            '<rdf:Description rdf:about="" xmlns:xmp="http://ns.adobe.com/xap/1.0/">'
+            f"{tags}"
+            "</rdf:Description>"
+            "</rdf:RDF>"
+            "</x:xmpmeta>"
+            '<?xpacket end="w"?>'
+        ).encode("utf-8")
+
+    def set_metadata(self, metadata: DocumentMetadata):
+        """Fill in a document's metadata, written into the PDF along with its pages."""
+        metadata.title = self.story["title"]
+        metadata.authors = [self.story["user"]["username"]]
+        metadata.description = self.story["description"].strip()
+        metadata.keywords = self.story["tags"]
+        metadata.created = self.story["createDate"]
+        metadata.modified = self.story["modifyDate"]
+        metadata.lang = self._get_valid_language_code()
+
     def add_metadata(self):
         """Write metadata to generated PDF file at self.book, using ExifTool."""
 
@@ -260,27 +490,29 @@ class PDFGenerator(AbstractGenerator):
             "Language": self._get_valid_language_code(),
             "Completed": self.story["completed"],
             "MatureContent": self.story["mature"],
-            "Producer": "Dhanush Rambhatla (TheOnlyWayUp - https://rambhat.la) and WattpadDownloader",
+            "Producer": PRODUCER,
         }  # As per https://exiftool.org/TagNames/PDF.html
 
-        with ExifTool(config_file=DATA_PATH / "exiftool.config") as et:
-            # Custom configuration adds Completed and MatureContent tags.
-            # exiftool logger logs executed command
-            et.execute(
-                *(
-                    [f"-{key}={value}" for key, value in metadata.items()]
-                    + [
-                        "-overwrite_original",
-                        self.book.file.name,
-                    ]
-                )
+        # exiftool logger logs executed command
+        pdf_exiftool().execute(
+            *(
+                [f"-{key}={value}" for key, value in metadata.items()]
+                + [
+                    "-overwrite_original",
+                    self.book.file.name,
+                ]
             )
+        )
 
     def compile(self):
-        parts = self.generate_chapters()
-        self.populate_template(parts)
-        self.generate_pdf()
-        self.add_metadata()
+        if self.chunk_chapters and len(self.parts) > self.chunk_chapters:
+            self.generate_chunked_pdf()
+        else:
+            parts = self.generate_chapters()
+            self.populate_template(parts)
+            self.generate_pdf()
+        if self.metadata_writer == "exiftool":
+            self.add_metadata()
         return True
 
     def dump(self) -> BytesIO:
@@ -289,3 +521,23 @@ class PDFGenerator(AbstractGenerator):
         self.book.close()
 
         return buffer
+
+
+def _pdf_date(date: str) -> str:
+    """PDF date string from an ISO 8601 timestamp, like Wattpad's."""
+    timestamp = datetime.fromisoformat(date)
+    if timestamp.tzinfo:
+        timestamp = timestamp.astimezone(timezone.utc)
+    return timestamp.strftime("D:%Y%m%d%H%M%SZ")
+
+
+def _even(pages: int) -> int:
+    return pages + pages % 2
+
+
+def _write_chunk(document: Document) -> IO[bytes]:
+    """Write a laid out chunk to a temporary file, leaving the layout to be freed."""
+    file = TemporaryFile()
+    document.write_pdf(file)
+    file.seek(0)
+    return file
@@ -2,18 +2,17 @@ from io import BytesIO
 from tempfile import _TemporaryFileWrapper
 from typing import Literal
 
-from bs4 import BeautifulSoup
 from ebooklib.epub import EpubBook
 
 from ..models import Story
 
 
 class AbstractGenerator:
-    """Compile parsed part trees to a file.
+    """Compile cleaned parts to a file.
 
     Args:
         metadata (Story): Story Metadata.
-        part_trees (List[BeautifulSoup]): Parsed part trees.
+        parts (List[str]): Cleaned part HTML, as returned by `clean_tree`.
         cover (bytes): Cover image.
         images (List[List[bytes | None]]): An array of images for each chapter, if images have been downloaded.
     """
@@ -21,19 +20,19 @@ class AbstractGenerator:
     def __init__(
         self,
         metadata: Story,
-        part_trees: list[BeautifulSoup],
+        parts: list[str],
         cover: bytes,
         images: list[list[bytes | None]],
     ):
         self.story = metadata
-        self.parts = part_trees
+        self.parts = parts
         self.cover = cover
         self.images = images
 
         self.book: EpubBook | _TemporaryFileWrapper = None  # type: ignore
 
     def compile(self) -> Literal[True]:
-        """Compile the part trees into the corresponding in-memory representation of the generator format.
+        """Compile the parts into the corresponding in-memory representation of the generator format.
 
         Returns:
             Literal[True]: Compiled successfully.
@@ -0,0 +1,327 @@
+from __future__ import annotations
+
+import asyncio
+import math
+import time
+from email.utils import parsedate_to_datetime
+from types import SimpleNamespace
+from typing import Callable, Literal, Optional
+
+from aiohttp import (
+    ClientSession,
+    TraceConfig,
+    TraceRequestEndParams,
+    TraceRequestStartParams,
+)
+from redis.asyncio import Redis
+from yarl import URL
+
+from .config import CacheTypes, Config
+from .exceptions import RateLimitedError
+from .logs import logger
+from .ratelimit import TokenBucket
+
+Endpoint = Literal["metadata", "storytext", "images", "login"]
+
+DECREASE_INTERVAL = 1.0  # seconds, a burst of 429s only slows an endpoint down once
+
+
+class EndpointLimiter:
+    """Adaptive outbound rate limit for one class of Wattpad endpoints.
+
+    Requests are paced by a token bucket and wait their turn, for at most `max_wait` seconds. The rate adapts AIMD-style: a 429 multiplies it by `decrease`, and each success adds `increase / rate`, recovering about `increase` requests/s for every second of successful traffic, up to `limit`. A Retry-After header puts the bucket into debt for that long, holding back every request to the endpoint.
+
+    Args:
+        name (Endpoint): Endpoint class.
+        limit (float): Highest rate, in requests/s. Also the starting rate.
+        min_rate (float): Lowest rate, in requests/s.
+        increase (float): Requests/s regained per second of successful requests.
+        decrease (float): Rate multiplier applied on a 429.
+        max_wait (float): Seconds a request may queue before RateLimitedError is raised.
+    """
+
+    def __init__(
+        self,
+        name: Endpoint,
+        limit: float,
+        min_rate: float,
+        increase: float,
+        decrease: float,
+        max_wait: float,
+    ):
+        self.name = name
+        self.limit = limit
+        self.min_rate = min_rate
+        self.increase = increase
+        self.decrease = decrease
+        self.max_wait = max_wait
+
+        self.bucket = TokenBucket(limit, max(1.0, limit))
+        self.last_decrease = 0.0
+
+        self.requests = 0
+        self.throttled = 0
+        self.rejected = 0
+        self.waited = 0.0
+
+    async def _take(self) -> float:
+        """Take a token, unless it's more than `max_wait` seconds away. Returns the delay either way."""
+        delay = self.bucket.delay()
+        if delay > self.max_wait:
+            self.bucket.tokens += 1  # Not used after all
+        return delay
+
+    async def _adjust(self, throttled: bool, pause: float):
+        rate = self.bucket.rate
+        if throttled:
+            now = time.monotonic()
+            if now - self.last_decrease >= DECREASE_INTERVAL:
+                self.last_decrease = now
+                rate = max(self.min_rate, rate * self.decrease)
+        else:
+            rate = min(self.limit, rate + self.increase / rate)
+
+        self.bucket.set_rate(rate, max(1.0, rate))
+        if pause:
+            self.bucket.tokens = min(self.bucket.tokens, -pause * rate)
+
+    async def _state(self) -> tuple[float, float]:
+        """Current rate, and seconds of queued requests."""
+        self.bucket.delay(0)  # Refill
+        return self.bucket.rate, max(0.0, -self.bucket.tokens / self.bucket.rate)
+
+    async def acquire(self):
+        """Wait for this request's turn.
+
+        Raises:
+            RateLimitedError: The wait would be longer than `max_wait`.
+        """
+        delay = await self._take()
+        if delay > self.max_wait:
+            self.rejected += 1
+            raise RateLimitedError(self.name, math.ceil(delay))
+
+        self.requests += 1
+        self.waited += delay
+        if delay:
+            await asyncio.sleep(delay)
+
+    async def record(self, status: int, retry_after: Optional[str] = None):
+        """Adapt the rate to a response's status."""
+        pause = _retry_after_seconds(retry_after)
+        if status == 429 or (status == 503 and pause):
+            self.throttled += 1
+            logger.warning(
+                f"Wattpad rate limited {self.name} requests, retry after {pause}s"
+            )
+            await self._adjust(True, pause)
+        elif status < 400:
+            await self._adjust(False, 0.0)
+
+    async def metrics(self) -> dict:
+        rate, backlog = await self._state()
+        return {
+            "rate": round(rate, 3),
+            "limit": self.limit,
+            "backlog": round(backlog, 3),
+            "requests": self.requests,
+            "throttled": self.throttled,
+            "rejected": self.rejected,
+            "waited": round(self.waited, 3),
+        }
+
+
+# Token bucket shared through Redis. Returns the delay, and only takes the token if the delay is within max_wait.
+_TAKE = """
+local now = redis.call('TIME')
+now = tonumber(now[1]) + tonumber(now[2]) / 1e6
+local limit, max_wait = tonumber(ARGV[1]), tonumber(ARGV[2])
+local state = redis.call('HMGET', KEYS[1], 'rate', 'tokens', 'updated')
+local rate = tonumber(state[1]) or limit
+local capacity = math.max(1, rate)
+local tokens = tonumber(state[2]) or capacity
+local updated = tonumber(state[3]) or now
+tokens = math.min(capacity, tokens + (now - updated) * rate)
+local delay = math.max(0, (1 - tokens) / rate)
+if delay <= max_wait then
+    tokens = tokens - 1
+end
+redis.call('HSET', KEYS[1], 'rate', rate, 'tokens', tokens, 'updated', now)
+redis.call('EXPIRE', KEYS[1], 3600)
+return tostring(delay)
+"""
+
+# AIMD step for a shared bucket, see EndpointLimiter._adjust.
+_ADJUST = """
+local now = redis.call('TIME')
+now = tonumber(now[1]) + tonumber(now[2]) / 1e6
+local limit, min_rate = tonumber(ARGV[1]), tonumber(ARGV[2])
+local increase, decrease = tonumber(ARGV[3]), tonumber(ARGV[4])
+local throttled, pause, interval = ARGV[5] == '1', tonumber(ARGV[6]), tonumber(ARGV[7])
+local state = redis.call('HMGET', KEYS[1], 'rate', 'tokens', 'updated', 'last_decrease')
+local rate = tonumber(state[1]) or limit
+local tokens = tonumber(state[2]) or math.max(1, rate)
+local updated = tonumber(state[3]) or now
+local last_decrease = tonumber(state[4]) or 0
+tokens = math.min(math.max(1, rate), tokens + (now - updated) * rate)
+if throttled then
+    if now - last_decrease >= interval then
+        last_decrease = now
+        rate = math.max(min_rate, rate * decrease)
+    end
+else
+    rate = math.min(limit, rate + increase / rate)
+end
+tokens = math.min(math.max(1, rate), tokens)
+if pause > 0 then
+    tokens = math.min(tokens, -pause * rate)
+end
+redis.call('HSET', KEYS[1], 'rate', rate, 'tokens', tokens, 'updated', now, 'last_decrease', last_decrease)
+redis.call('EXPIRE', KEYS[1], 3600)
+return {tostring(rate), tostring(tokens)}
+"""
+
+
+class SharedEndpointLimiter(EndpointLimiter):
+    """EndpointLimiter whose bucket and rate live in Redis, so every instance sharing it adapts together and honours the same Retry-After."""
+
+    def __init__(self, *args, redis: Callable[[], Redis], **kwargs):
+        super().__init__(*args, **kwargs)
+        self.key = f"wpd-governor:{self.name}"
+        self._redis = redis
+
+    async def _take(self) -> float:
+        return float(
+            await self._redis().eval(_TAKE, 1, self.key, self.limit, self.max_wait)
+        )
+
+    async def _adjust(self, throttled: bool, pause: float):
+        await self._redis().eval(
+            _ADJUST,
+            1,
+            self.key,
+            self.limit,
+            self.min_rate,
+            self.increase,
+            self.decrease,
+            int(throttled),
+            pause,
+            DECREASE_INTERVAL,
+        )
+
+    async def _state(self) -> tuple[float, float]:
+        rate, tokens, updated = await self._redis().hmget(
+            self.key, "rate", "tokens", "updated"
+        )
+        if rate is None:
+            return self.limit, 0.0
+
+        rate = float(rate)
+        # Refilled since the last update, by the local clock
+        tokens = float(tokens) + (time.time() - float(updated)) * rate
+        return rate, max(0.0, -tokens / rate)
+
+
+class OutboundGovernor:
+    """Pace every request to Wattpad, per class of endpoint.
+
+    Hooks into aiohttp sessions as a TraceConfig, so requests answered from the response cache skip it entirely.
+
+    Args:
+        limiters (dict[Endpoint, EndpointLimiter]): Limiter per endpoint class.
+    """
+
+    def __init__(self, limiters: dict[Endpoint, EndpointLimiter]):
+        self.limiters = limiters
+
+    @staticmethod
+    def classify(url: URL) -> Endpoint:
+        """Endpoint class of a wattpad.com request."""
+        if url.path.startswith("/auth/"):
+            return "login"
+        if url.path.startswith("/apiv2/") and url.query.get("m") == "storytext":
+            return "storytext"
+        return "metadata"
+
+    def trace_config(self, endpoint: Optional[Endpoint] = None) -> TraceConfig:
+        """Trace hooks for a session. Requests are classified by URL, unless `endpoint` is given."""
+
+        async def on_request_start(
+            session: ClientSession,
+            context: SimpleNamespace,
+            params: TraceRequestStartParams,
+        ):
+            context.limiter = self.limiters[endpoint or self.classify(params.url)]
+            await context.limiter.acquire()
+
+        async def on_request_end(
+            session: ClientSession,
+            context: SimpleNamespace,
+            params: TraceRequestEndParams,
+        ):
+            await context.limiter.record(
+                params.response.status, params.response.headers.get("Retry-After")
+            )
+
+        trace_config = TraceConfig()
+        trace_config.on_request_start.append(on_request_start)
+        trace_config.on_request_end.append(on_request_end)
+        return trace_config
+
+    async def metrics(self) -> dict:
+        return {
+            name: await limiter.metrics() for name, limiter in self.limiters.items()
+        }
+
+
+def create_governor(config: Config) -> OutboundGovernor:
+    limits: dict[Endpoint, float] = {
+        "metadata": config.RATE_LIMIT_METADATA,
+        "storytext": config.RATE_LIMIT_STORYTEXT,
+        "images": config.RATE_LIMIT_IMAGES,
+        "login": config.RATE_LIMIT_LOGIN,
+    }
+    shared = config.RATE_LIMIT_SHARED and config.CACHE_TYPE == CacheTypes.redis
+
+    def redis() -> Redis:
+        # storage imports vars, which creates the governor
+        from .storage import redis_client
+
+        return redis_client()
+
+    limiters: dict[Endpoint, EndpointLimiter] = {}
+    for name, limit in limits.items():
+        args = (
+            name,
+            limit,
+            limit * config.RATE_LIMIT_MIN_FRACTION,
+            config.RATE_LIMIT_INCREASE,
+            config.RATE_LIMIT_DECREASE,
+            config.RATE_LIMIT_MAX_WAIT,
+        )
+        limiters[name] = (
+            SharedEndpointLimiter(*args, redis=redis)
+            if shared
+            else EndpointLimiter(*args)
+        )
+
+    logger.info(
+        f"Using {'shared' if shared else 'local'} outbound rate limits: {limits}"
+    )
+    return OutboundGovernor(limiters)
+
+
+def _retry_after_seconds(value: Optional[str]) -> float:
+    """Seconds to wait from a Retry-After header, in either delay-seconds or HTTP-date form."""
+    if not value:
+        return 0.0
+
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return 0.0
@@ -0,0 +1,58 @@
+from hashlib import sha256
+from typing import Optional
+
+from .storage import BlobStore, create_store
+from .vars import config
+
+
+class ImageStore:
+    """Downloaded images, keyed by URL and deduplicated by content hash.
+
+    URLs map to the SHA-256 of their content, and content is stored once per hash, so the same illustration reached through different URLs (e.g. re-uploads, or the same cover at different sizes once resized) is only stored once.
+
+    Args:
+        store (BlobStore): Backend for both the URL index and image content.
+    """
+
+    def __init__(self, store: BlobStore):
+        self.store = store
+
+        self.hits = 0
+        self.misses = 0
+
+    async def get(self, url: str) -> bytes | None:
+        digest = await self.store.get(f"url:{url}")
+        data = await self.store.get(f"blob:{digest.decode()}") if digest else None
+
+        if data is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+
+        return data
+
+    async def set(self, url: str, data: bytes):
+        digest = sha256(data).hexdigest()
+        await self.store.set(f"blob:{digest}", data)
+        await self.store.set(f"url:{url}", digest.encode())
+
+    async def get_processed(self, key: str) -> bytes | None:
+        """Processed image, keyed by source content hash and processing settings."""
+        return await self.store.get(f"processed:{key}")
+
+    async def set_processed(self, key: str, data: bytes):
+        await self.store.set(f"processed:{key}", data)
+
+    async def metrics(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "bytes": await self.store.size(),
+            "max_bytes": self.store.max_bytes,
+        }
+
+
+_store = create_store("images", config.IMAGE_CACHE_MAX_BYTES, config.IMAGE_CACHE_TTL)
+image_store: Optional[ImageStore] = ImageStore(_store) if _store else None
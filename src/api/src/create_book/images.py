@@ -0,0 +1,114 @@
+from __future__ import annotations
+
+import asyncio
+from hashlib import sha256
+from io import BytesIO
+from typing import NamedTuple
+
+from eliot import start_action
+from PIL import Image, ImageOps
+
+from .image_store import image_store
+from .logs import logger
+from .scheduler import scheduler
+from .vars import config
+
+QUALITY_PRESETS = {"high": 90, "balanced": 80, "small": 65}
+
+
+class ImagePreset(NamedTuple):
+    max_dimension: int
+    encoding: str  # Pillow format name
+    quality: int
+
+
+def image_preset(format: str) -> ImagePreset:
+    """Processing settings for a book format."""
+    quality = QUALITY_PRESETS[config.IMAGE_QUALITY]
+    match format:
+        case "pdf":
+            # WeasyPrint embeds JPEGs as-is but stores other formats uncompressed.
+            return ImagePreset(config.IMAGE_MAX_DIMENSION_PDF, "JPEG", quality)
+        case "mobi":
+            return ImagePreset(config.IMAGE_MAX_DIMENSION_MOBI, "JPEG", quality)
+        case _:
+            return ImagePreset(
+                config.IMAGE_MAX_DIMENSION_EPUB, config.IMAGE_ENCODING.upper(), quality
+            )
+
+
+def process_image(data: bytes, preset: ImagePreset) -> bytes:
+    """Downscale and re-encode an image, dropping its metadata. Runs in a worker process.
+
+    Animated images and images that can't be decoded are returned untouched, as is the original if re-encoding doesn't make it smaller.
+    """
+    try:
+        with Image.open(BytesIO(data)) as image:
+            if getattr(image, "is_animated", False):
+                return data
+
+            # Orientation is lost with the EXIF data
+            image = ImageOps.exif_transpose(image)
+            image.thumbnail((preset.max_dimension, preset.max_dimension))
+
+            has_alpha = image.mode in ("RGBA", "LA") or (
+                image.mode == "P" and "transparency" in image.info
+            )
+
+            output = BytesIO()
+            if has_alpha and preset.encoding == "JPEG":
+                image.save(output, "PNG", optimize=True)
+            else:
+                if image.mode not in ("RGB", "L", "RGBA"):
+                    image = image.convert("RGB")
+                image.save(
+                    output, preset.encoding, quality=preset.quality, optimize=True
+                )
+    except (OSError, ValueError, Image.DecompressionBombError):
+        return data
+
+    processed = output.getvalue()
+    return processed if len(processed) < len(data) else data
+
+
+async def process_images(
+    images: list[list[bytes | None]], format: str
+) -> list[list[bytes | None]]:
+    """Process every chapter image for `format` in the build pool, reusing processed results from the image store."""
+    preset = image_preset(format)
+
+    digests = [
+        [sha256(data).hexdigest() if data else None for data in part] for part in images
+    ]
+    unique = {
+        digest: data
+        for part, part_digests in zip(images, digests)
+        for data, digest in zip(part, part_digests)
+        if data and digest
+    }
+    processed: dict[str, bytes] = {}
+
+    async def process(digest: str, data: bytes):
+        key = f"{digest}:{preset.max_dimension}:{preset.encoding}:{preset.quality}"
+        if image_store and (cached := await image_store.get_processed(key)):
+            processed[digest] = cached
+            return
+
+        processed[digest] = await scheduler.submit(
+            "images", process_image, data, preset
+        )
+        if image_store:
+            await image_store.set_processed(key, processed[digest])
+
+    with start_action(action_type="process_images", count=len(unique), format=format):
+        await asyncio.gather(
+            *[process(digest, data) for digest, data in unique.items()]
+        )
+
+    saved = sum(map(len, unique.values())) - sum(map(len, processed.values()))
+    logger.info(f"Processed {len(unique)} images for {format}, saving {saved} bytes")
+
+    return [
+        [processed[digest] if digest else None for digest in part_digests]
+        for part_digests in digests
+    ]
@@ -0,0 +1,236 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import time
+from pathlib import Path
+from tempfile import gettempdir
+from typing import Awaitable, Callable, Literal, Optional, TypedDict
+from uuid import uuid4
+
+from aiohttp import ClientResponseError
+
+from .config import CacheTypes
+from .exceptions import (
+    BuildQueueFullError,
+    MissingCoverError,
+    RateLimitedError,
+    WattpadError,
+)
+from .logs import logger
+from .storage import BlobStore, FileBlobStore, create_store, redis_client
+from .vars import config
+
+
+class Job(TypedDict):
+    id: str
+    status: Literal["queued", "running", "done", "failed"]
+    phase: str  # What the build is doing, e.g. "chapters" or "building"
+    percent: float
+    created: float
+    story_id: int
+    format: str
+    filename: str
+    result: Optional[str]  # Key of the finished book
+    shared: bool  # Whether the book is in the artifact store, rather than the job store
+    error: Optional[str]
+
+
+# Reports the build's phase and overall percent done.
+Progress = Callable[[str, float], Awaitable[None]]
+
+
+class JobBroker:
+    """Job records, kept for `ttl` seconds after they're last updated."""
+
+    def __init__(self, ttl: int):
+        self.ttl = ttl
+
+    async def get(self, id: str) -> Job | None:
+        raise NotImplementedError
+
+    async def put(self, job: Job):
+        raise NotImplementedError
+
+    async def update(self, id: str, **fields):
+        if job := await self.get(id):
+            job.update(fields)  # type: ignore
+            await self.put(job)
+
+
+class MemoryJobBroker(JobBroker):
+    """Job records in this process. Jobs are only visible to the instance running them."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._jobs: dict[str, tuple[float, Job]] = {}
+
+    async def get(self, id: str) -> Job | None:
+        now = time.time()
+        for expired in [key for key, (expiry, _) in self._jobs.items() if expiry < now]:
+            del self._jobs[expired]
+
+        if entry := self._jobs.get(id):
+            return entry[1].copy()  # type: ignore
+        return None
+
+    async def put(self, job: Job):
+        self._jobs[job["id"]] = (time.time() + self.ttl, job.copy())  # type: ignore
+
+
+class RedisJobBroker(JobBroker):
+    """Job records in Redis, visible to every instance sharing it."""
+
+    async def get(self, id: str) -> Job | None:
+        data = await redis_client().get(f"wpd-jobs:{id}")
+        return json.loads(data) if data else None
+
+    async def put(self, job: Job):
+        await redis_client().set(f"wpd-jobs:{job['id']}", json.dumps(job), ex=self.ttl)
+
+
+class JobQueue:
+    """Run builds in the background, independent of the request that submitted them.
+
+    Jobs are run by this instance, at most `workers` at a time, and their records are kept in `broker`. Jobs that are waiting count towards `queue_depth`, past which submissions are rejected.
+
+    Args:
+        broker (JobBroker): Store for job records.
+        workers (int): Jobs run concurrently.
+        queue_depth (int): Jobs running or waiting, before submissions are rejected.
+        retry_after (int): Seconds clients are told to wait when the queue is full.
+    """
+
+    def __init__(
+        self, broker: JobBroker, workers: int, queue_depth: int, retry_after: int
+    ):
+        self.broker = broker
+        self.queue_depth = queue_depth
+        self.retry_after = retry_after
+
+        self._semaphore = asyncio.Semaphore(workers)
+        self._tasks: set[asyncio.Task] = set()
+
+    async def submit(
+        self,
+        story_id: int,
+        format: str,
+        filename: str,
+        work: Callable[[str, Progress], Awaitable[tuple[str, bool]]],
+    ) -> Job:
+        """Queue `work`, which is called with the job's ID and a progress callback, and returns the finished book's key and whether it's in the artifact store.
+
+        Raises:
+            BuildQueueFullError: Too many jobs are running or waiting.
+        """
+        if len(self._tasks) >= self.queue_depth:
+            raise BuildQueueFullError(self.retry_after)
+
+        job: Job = {
+            "id": uuid4().hex,
+            "status": "queued",
+            "phase": "queued",
+            "percent": 0.0,
+            "created": time.time(),
+            "story_id": story_id,
+            "format": format,
+            "filename": filename,
+            "result": None,
+            "shared": False,
+            "error": None,
+        }
+        await self.broker.put(job)
+
+        task = asyncio.create_task(self._run(job["id"], work))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+        return job
+
+    async def _run(
+        self, id: str, work: Callable[[str, Progress], Awaitable[tuple[str, bool]]]
+    ):
+        last: tuple[str, int] = ("queued", 0)
+
+        async def progress(phase: str, percent: float):
+            nonlocal last
+            # Writes are limited to phase changes and whole percents.
+            if (phase, int(percent)) != last:
+                last = (phase, int(percent))
+                await self.broker.update(id, phase=phase, percent=round(percent, 1))
+
+        async with self._semaphore:
+            await self.broker.update(id, status="running", phase="starting")
+            try:
+                result, shared = await work(id, progress)
+            except asyncio.CancelledError:
+                await self.broker.update(id, status="failed", error="Cancelled.")
+                raise
+            except Exception as exception:
+                logger.exception(f"Job {id} failed")
+                await self.broker.update(
+                    id, status="failed", error=describe_error(exception)
+                )
+            else:
+                await self.broker.update(
+                    id,
+                    status="done",
+                    phase="done",
+                    percent=100.0,
+                    result=result,
+                    shared=shared,
+                )
+
+    async def get(self, id: str) -> Job | None:
+        return await self.broker.get(id)
+
+    def metrics(self) -> dict:
+        return {
+            "pending": len(self._tasks),
+            "queue_depth": self.queue_depth,
+        }
+
+    async def close(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+
+def describe_error(exception: Exception) -> str:
+    """Short, user-facing description of why a job failed."""
+    match exception:
+        case WattpadError():
+            return "This story does not exist, or has been deleted."
+        case ClientResponseError(status=429) | RateLimitedError():
+            return "The website is overloaded. Please try again in a few minutes."
+        case BuildQueueFullError():
+            return "Too many books are being generated right now. Please try again in a minute."
+        case MissingCoverError():
+            return "This story's cover could not be downloaded. Please try again in a few minutes."
+        case _:
+            return "Something went wrong."
+
+
+def create_broker() -> JobBroker:
+    match config.CACHE_TYPE:
+        case CacheTypes.redis:
+            return RedisJobBroker(config.JOB_TTL)
+        case _:
+            return MemoryJobBroker(config.JOB_TTL)
+
+
+# Books built by jobs that can't go into the artifact store: built with cookies, or with caching disabled.
+job_store: BlobStore = create_store(
+    "jobs", config.JOB_RESULT_MAX_BYTES, config.JOB_TTL
+) or FileBlobStore(
+    Path(gettempdir()) / "wpd" / "jobs",
+    "jobs",
+    config.JOB_RESULT_MAX_BYTES,
+    config.JOB_TTL,
+)
+job_queue = JobQueue(
+    create_broker(),
+    config.JOB_WORKERS,
+    config.JOB_QUEUE_DEPTH,
+    config.BUILD_RETRY_AFTER,
+)
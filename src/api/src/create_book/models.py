@@ -22,6 +22,7 @@ class User(TypedDict):
 class Part(TypedDict):
     id: int
     title: str
+    modifyDate: str
 
 
 class Story(TypedDict):
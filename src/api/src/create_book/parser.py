@@ -1,13 +1,23 @@
 import asyncio
-from itertools import batched
-from typing import cast
+from io import BytesIO
+from tempfile import NamedTemporaryFile
+from typing import AsyncIterator, Optional, cast
+from zipfile import ZipFile
 
-from aiohttp import ClientSession
+import backoff
+from aiohttp import ClientError, ClientTimeout
 from bs4 import BeautifulSoup, Tag
 from eliot import start_action
-from urllib.parse import urlparse
 
-from .vars import headers
+from .cleaner import CleanedPart, clean_part
+from .create_book import fetch_part_content, fetch_story_content_zip
+from .exceptions import RateLimitedError
+from .image_store import image_store
+from .logs import logger
+from .models import Part, Story
+from .part_store import part_store
+from .scheduler import scheduler
+from .vars import clients, config
 
 
 def clean_tree(title: str, id: int, body: str) -> BeautifulSoup:
@@ -62,31 +72,184 @@ def clean_tree(title: str, id: int, body: str) -> BeautifulSoup:
     return new_soup
 
 
-async def fetch_image(url: str) -> bytes | None:
-    """Fetch image bytes."""
-    with start_action(action_type="api_fetch_image", url=url):
-        async with ClientSession(headers=headers) as session:  # Don't cache images.
-            async with session.get(url) as response:
-                if not response.ok:
-                    return None
-
-                body = await response.read()
-
-        return body
+@backoff.on_exception(
+    backoff.expo,
+    (ClientError, TimeoutError),
+    max_tries=config.IMAGE_FETCH_RETRIES + 1,
+)
+async def _download_image(url: str) -> bytes | None:
+    session = await clients.images()
+    async with session.get(
+        url, timeout=ClientTimeout(total=config.IMAGE_FETCH_TIMEOUT)
+    ) as response:
+        if response.status == 429 or response.status >= 500:
+            response.raise_for_status()  # Worth retrying
+        if not response.ok:
+            return None
 
+        return await response.read()
 
-async def fetch_tree_images(tree: BeautifulSoup):
-    """Return a Generator of bytes containing image data for all images referenced in the tree."""
 
-    image_urls = []
-    for img in tree.find_all("img"):
-        parsed = urlparse(img["src"])
-        if parsed.scheme and parsed.netloc: # Test if valid URL
-            image_urls.append(img["src"])
-
-    images = []
-    for chunk in batched(image_urls, 3):
-        for image_data in await asyncio.gather(*[fetch_image(url) for url in chunk]):
-            images.append(image_data)
+async def fetch_image(url: str) -> bytes | None:
+    """Fetch image bytes, from the image store if possible."""
+    if image_store and (data := await image_store.get(url)):
+        return data
 
-    return images
+    with start_action(action_type="api_fetch_image", url=url):
+        try:
+            data = await _download_image(url)
+        except (ClientError, TimeoutError, RateLimitedError) as exception:
+            logger.warning(f"Giving up on image {url=}: {exception!r}")
+            return None
+
+    if image_store and data:
+        await image_store.set(url, data)
+
+    return data
+
+
+def clean(title: str, id: int, body: str) -> CleanedPart:
+    """Clean a part with the configured engine."""
+    if config.CLEANER == "lxml":
+        return clean_part(title, id, body)
+
+    tree = clean_tree(title, id, body)
+    return CleanedPart(str(tree), tree_image_urls(tree))
+
+
+def clean_members(path: str, members: list[tuple[str, int]]) -> list[CleanedPart]:
+    """Clean parts read straight from a story zip on disk. Runs in a worker process.
+
+    Args:
+        path (str): Path of the story zip.
+        members (list[tuple[str, int]]): Title and ID of each part to clean.
+
+    Returns:
+        list[CleanedPart]: Cleaned parts, aligned with `members`.
+    """
+    with ZipFile(path, "r") as archive:
+        return [
+            clean(title, id, archive.read(str(id)).decode("utf-8"))
+            for title, id in members
+        ]
+
+
+async def clean_archive(
+    story_zip: BytesIO, members: list[tuple[str, int]]
+) -> AsyncIterator[tuple[int, CleanedPart]]:
+    """Clean parts of a story zip in the build pool, PARSE_CHUNK_SIZE parts per task.
+
+    Workers open a temporary copy of the zip themselves, so only part names and cleaned parts cross process boundaries.
+
+    Yields:
+        tuple[int, CleanedPart]: Index in `members` and cleaned part, as each chunk finishes.
+    """
+    starts = range(0, len(members), config.PARSE_CHUNK_SIZE)
+
+    with NamedTemporaryFile(suffix=".zip") as file:
+        await asyncio.to_thread(file.write, story_zip.getbuffer())
+        await asyncio.to_thread(file.flush)
+
+        tasks = {
+            asyncio.ensure_future(
+                scheduler.submit(
+                    "parse",
+                    clean_members,
+                    file.name,
+                    members[start : start + config.PARSE_CHUNK_SIZE],
+                )
+            ): start
+            for start in starts
+        }
+        try:
+            # Yields the original tasks, in completion order.
+            async for task in asyncio.as_completed(tasks):
+                for offset, part in enumerate(task.result()):
+                    yield tasks[task] + offset, part
+        finally:
+            for task in tasks:
+                task.cancel()
+
+
+async def _fetch_individually(
+    parts: list[Part], indices: list[int], cookies: Optional[dict]
+) -> AsyncIterator[tuple[int, CleanedPart]]:
+    """Fetch parts from the per-part endpoint and clean them in threads, yielding them as they finish."""
+
+    async def fetch(idx: int) -> tuple[int, CleanedPart]:
+        part = parts[idx]
+        # Only called with the part store, which is the cache.
+        body = await fetch_part_content(part["id"], cookies, cached=False)
+        return idx, await asyncio.to_thread(clean, part["title"], part["id"], body)
+
+    tasks = [asyncio.ensure_future(fetch(idx)) for idx in indices]
+    try:
+        async for task in asyncio.as_completed(tasks):
+            yield task.result()
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+async def iter_parts(
+    metadata: Story, story_id: int, cookies: Optional[dict] = None
+) -> AsyncIterator[tuple[int, CleanedPart]]:
+    """Every part, cleaned, only fetching parts that were added or edited since they were last stored.
+
+    A few changed parts are fetched individually and cleaned in threads. Past PART_FETCH_MAX_REQUESTS, or when none of the story's parts are stored yet, one download of the story zip is cheaper, and its parts are cleaned across the build pool. With the part store, parts are never fetched through the response cache, which could hand back text from before the part's current `modifyDate`. Parts fetched with cookies may be paywalled, so they're neither read from nor written to the part store, but the story zip may come from the private cache.
+
+    Args:
+        metadata (Story): Story Metadata.
+        story_id (int): Story ID.
+        cookies (Optional[dict]): Authorization cookies.
+
+    Yields:
+        tuple[int, CleanedPart]: Index and cleaned part, as soon as each is available. Stored parts come first.
+    """
+    parts = metadata["parts"]
+    store = None if cookies else part_store
+
+    stored: list[CleanedPart | None] = (
+        list(await asyncio.gather(*[store.get(part) for part in parts]))
+        if store
+        else [None] * len(parts)
+    )
+    missing = [idx for idx, part in enumerate(stored) if part is None]
+    for idx, part in enumerate(stored):
+        if part is not None:
+            yield idx, part
+
+    if not missing:
+        logger.info(f"All {len(parts)} parts stored ({story_id=})")
+        return
+
+    logger.info(f"Fetching {len(missing)} of {len(parts)} parts ({story_id=})")
+    if (
+        store
+        and len(missing) < len(parts)
+        and len(missing) <= config.PART_FETCH_MAX_REQUESTS
+    ):
+        fetched = _fetch_individually(parts, missing, cookies)
+    else:
+        story_zip = await fetch_story_content_zip(
+            story_id, cookies, metadata["modifyDate"], cached=not store
+        )
+        fetched = (
+            (missing[member], part)
+            async for member, part in clean_archive(
+                story_zip,
+                [(parts[idx]["title"], parts[idx]["id"]) for idx in missing],
+            )
+        )
+
+    async for idx, part in fetched:
+        if store:
+            await store.set(parts[idx], part)
+        yield idx, part
+
+    logger.info(f"Fetched {len(missing)} of {len(parts)} parts ({story_id=})")
+
+
+def tree_image_urls(tree: BeautifulSoup) -> list[str]:
+    """Image URLs referenced in the tree, in document order."""
+    return [img.get("src", "") for img in tree.find_all("img")]
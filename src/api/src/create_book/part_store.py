@@ -0,0 +1,55 @@
+import json
+from typing import Optional
+
+from .cleaner import CleanedPart
+from .models import Part
+from .storage import BlobStore, create_store
+from .vars import config
+
+CLEANER_VERSION = 2  # Bump when cleaner output or the stored format changes, invalidating stored parts.
+
+
+class PartStore:
+    """Cleaned parts, keyed by part id and the part's `modifyDate`.
+
+    Editing a part bumps its `modifyDate`, so a refreshed story only misses on the parts that were added or edited since it was last downloaded.
+
+    Args:
+        store (BlobStore): Backend for part content.
+    """
+
+    def __init__(self, store: BlobStore):
+        self.store = store
+
+        self.hits = 0
+        self.misses = 0
+
+    def _key(self, part: Part) -> str:
+        return f"{CLEANER_VERSION}:{part['id']}:{part['modifyDate']}"
+
+    async def get(self, part: Part) -> CleanedPart | None:
+        data = await self.store.get(self._key(part))
+
+        if data is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return CleanedPart(*json.loads(data))
+
+    async def set(self, part: Part, cleaned: CleanedPart):
+        await self.store.set(self._key(part), json.dumps(cleaned).encode("utf-8"))
+
+    async def metrics(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "bytes": await self.store.size(),
+            "max_bytes": self.store.max_bytes,
+        }
+
+
+_store = create_store("parts", config.PART_CACHE_MAX_BYTES, config.PART_CACHE_TTL)
+part_store: Optional[PartStore] = PartStore(_store) if _store else None
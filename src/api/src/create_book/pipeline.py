@@ -0,0 +1,247 @@
+from __future__ import annotations
+
+import asyncio
+import pickle
+from os import path
+from tempfile import SpooledTemporaryFile, TemporaryDirectory
+from typing import TYPE_CHECKING, AsyncIterator, BinaryIO, NamedTuple, Optional
+from urllib.parse import urlparse
+
+from .cleaner import CleanedPart
+from .exceptions import MissingCoverError
+from .images import process_images
+from .logs import logger
+from .models import Story
+from .parser import fetch_image, iter_parts
+from .scheduler import scheduler, write_epub
+from .vars import config
+
+if TYPE_CHECKING:
+    from .jobs import Progress
+
+
+class Chapter(NamedTuple):
+    idx: int
+    part: CleanedPart
+    # Aligned with `part.images`, empty if images weren't requested
+    images: list[bytes | None]
+
+
+_image_semaphore = asyncio.Semaphore(config.IMAGE_FETCH_CONCURRENCY)
+
+
+async def _fetch_image_limited(url: str) -> bytes | None:
+    """Fetch an image, at most IMAGE_FETCH_CONCURRENCY at once across all builds."""
+    async with _image_semaphore:
+        return await fetch_image(url)
+
+
+def _is_url(url: str) -> bool:
+    parsed = urlparse(url)
+    return bool(parsed.scheme and parsed.netloc)
+
+
+def _spool(chapter_path: str, chapter: tuple[str, list[bytes | None]]):
+    with open(chapter_path, "wb") as file:
+        pickle.dump(chapter, file, pickle.HIGHEST_PROTOCOL)
+
+
+class ChapterPipeline:
+    """Fetch, clean and illustrate a story's chapters concurrently, handing them out in story order.
+
+    Parts are cleaned as soon as they're available (see `iter_parts`), and each chapter's images are fetched as soon as it's cleaned, so image downloads for one chapter overlap cleaning of the next. A bounded queue keeps at most PIPELINE_DEPTH chapters ahead of the consumer, bounding the images held in memory while a book is written chapter by chapter.
+
+    Work starts on creation. Use as an async context manager so it's cancelled if the consumer gives up.
+
+    Args:
+        metadata (Story): Story Metadata.
+        story_id (int): Story ID.
+        format (str): Book format, for image processing settings.
+        download_images (bool): Whether to fetch chapter images.
+        cookies (Optional[dict]): Authorization cookies.
+    """
+
+    def __init__(
+        self,
+        metadata: Story,
+        story_id: int,
+        format: str,
+        download_images: bool,
+        cookies: Optional[dict] = None,
+    ):
+        self.metadata = metadata
+        self.story_id = story_id
+        self.format = format
+        self.download_images = download_images
+        self.cookies = cookies
+
+        self.queue: asyncio.Queue[
+            tuple[int, CleanedPart, asyncio.Future[list[bytes | None]]] | Exception
+        ] = asyncio.Queue(maxsize=config.PIPELINE_DEPTH)
+        self._fetches: dict[str, asyncio.Future[bytes | None]] = {}
+        self._producer = asyncio.ensure_future(self._produce())
+
+    def _fetch(self, url: str) -> asyncio.Future[bytes | None]:
+        # Shared while in flight, later chapters reusing a URL hit the image store instead.
+        if url not in self._fetches:
+            self._fetches[url] = asyncio.ensure_future(_fetch_image_limited(url))
+            self._fetches[url].add_done_callback(lambda _: self._fetches.pop(url, None))
+
+        return self._fetches[url]
+
+    async def _images(self, part: CleanedPart) -> list[bytes | None]:
+        if not self.download_images:
+            return []
+
+        fetches = [self._fetch(url) if _is_url(url) else None for url in part.images]
+        images = [await fetch if fetch else None for fetch in fetches]
+
+        if config.IMAGE_PROCESSING and any(images):
+            images = (await process_images([images], self.format))[0]
+
+        return images
+
+    async def _produce(self):
+        pending: dict[int, CleanedPart] = {}
+        next_idx = 0
+
+        try:
+            async for idx, part in iter_parts(
+                self.metadata, self.story_id, self.cookies
+            ):
+                pending[idx] = part
+                while next_idx in pending:
+                    part = pending.pop(next_idx)
+                    await self.queue.put(
+                        (next_idx, part, asyncio.ensure_future(self._images(part)))
+                    )
+                    next_idx += 1
+        except Exception as exception:
+            await self.queue.put(exception)  # Raised to the consumer
+
+    async def __aiter__(self) -> AsyncIterator[Chapter]:
+        for _ in self.metadata["parts"]:
+            item = await self.queue.get()
+            if isinstance(item, Exception):
+                raise item
+
+            idx, part, images = item
+            yield Chapter(idx, part, await images)
+
+    def close(self):
+        self._producer.cancel()
+        while not self.queue.empty():
+            item = self.queue.get_nowait()
+            if not isinstance(item, Exception):
+                item[2].cancel()
+        for fetch in list(self._fetches.values()):
+            fetch.cancel()
+
+    async def __aenter__(self) -> ChapterPipeline:
+        return self
+
+    async def __aexit__(self, *_):
+        self.close()
+
+
+async def build_book(
+    metadata: Story,
+    story_id: int,
+    format: str,
+    download_images: bool,
+    cookies: Optional[dict],
+    progress: Optional[Progress] = None,
+) -> BinaryIO:
+    """Fetch, parse and compile a story, returning a file containing the book.
+
+    The cover and author avatar are fetched alongside the story's parts. With the stream EPUB writer, chapters are spooled to disk as they become available and the book is written from them in the build pool, so neither process holds the whole book in memory.
+
+    `progress` is told the current phase, and how much of the build is done, in percent.
+
+    Raises:
+        MissingCoverError: The cover, or the author's avatar for PDFs, couldn't be downloaded.
+    """
+    total = len(metadata["parts"]) or 1
+
+    async def report(phase: str, percent: float):
+        if progress:
+            await progress(phase, percent)
+
+    cover_task = asyncio.ensure_future(
+        fetch_image(metadata["cover"].replace("-256-", "-512-"))  # Increase resolution
+    )
+    author_task = (
+        asyncio.ensure_future(
+            fetch_image(metadata["user"]["avatar"].replace("-256-", "-512-"))
+        )
+        if format == "pdf"
+        else None
+    )
+
+    book_file: Optional[BinaryIO] = None
+    try:
+        async with ChapterPipeline(
+            metadata, story_id, format, download_images, cookies
+        ) as chapters:
+            cover_data = await cover_task
+            if not cover_data:
+                raise MissingCoverError("Story cover couldn't be downloaded.")
+
+            logger.info(f"Retrieved story metadata and cover ({story_id=})")
+
+            if format == "epub" and config.EPUB_WRITER == "stream":
+                with TemporaryDirectory(prefix="wpd-epub-") as spool:
+                    spooled: list[tuple[int, str]] = []
+                    async for chapter in chapters:
+                        chapter_path = path.join(spool, f"{chapter.idx}.pickle")
+                        await asyncio.to_thread(
+                            _spool, chapter_path, (chapter.part.html, chapter.images)
+                        )
+                        spooled.append((chapter.idx, chapter_path))
+                        await report("chapters", len(spooled) / total * 80)
+
+                    await report("building", 80)
+                    book_path = path.join(spool, "book.epub")
+                    await scheduler.run(
+                        "epub", write_epub, book_path, metadata, cover_data, spooled
+                    )
+                    # Still readable once the spool is removed.
+                    book_file = open(book_path, "rb")
+            else:
+                collected: list[Chapter] = []
+                async for chapter in chapters:
+                    collected.append(chapter)
+                    await report("chapters", len(collected) / total * 80)
+
+                author_image = None
+                if author_task:
+                    author_image = await author_task
+                    if not author_image:
+                        raise MissingCoverError("Author avatar couldn't be downloaded.")
+
+                await report("building", 80)
+                book_data = await scheduler.build(
+                    format,
+                    metadata,
+                    [chapter.part.html for chapter in collected],
+                    cover_data,
+                    [chapter.images for chapter in collected]
+                    if download_images
+                    else [],
+                    author_image,
+                )
+                book_file = SpooledTemporaryFile(
+                    max_size=config.DOWNLOAD_SPOOL_MAX_BYTES
+                )
+                await asyncio.to_thread(book_file.write, book_data)
+    except BaseException:
+        if book_file:
+            book_file.close()
+        raise
+    finally:
+        cover_task.cancel()
+        if author_task:
+            author_task.cancel()
+
+    book_file.seek(0)
+    return book_file
@@ -0,0 +1,74 @@
+from __future__ import annotations
+
+import json
+from typing import Optional
+
+from .crypto import decrypt, private_cipher, private_key
+from .storage import BlobStore, create_store
+from .vars import config
+
+
+class PrivateCache:
+    """Wattpad responses fetched with cookies, cached separately for each user.
+
+    Responses to authenticated requests may contain paywalled or private stories, so they never go into the shared response cache. Here, entries are namespaced by a salted hash of the user's identity and encrypted with a key derived from it: an entry can only be found, and read, with the cookies it was fetched with. Entries last `ttl` seconds, which should be short, as a user can lose access to a story at any time.
+
+    Args:
+        store (BlobStore): Backend for encrypted responses.
+        ttl (int): Seconds an entry is kept.
+    """
+
+    def __init__(self, store: BlobStore, ttl: int):
+        self.store = store
+        self.ttl = ttl
+
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _identity(cookies: dict) -> str:
+        # Wattpad's token cookie identifies the logged in user. Without it, the whole set does.
+        if token := cookies.get("token"):
+            return str(token)
+        return json.dumps(sorted(cookies.items()))
+
+    def _key(self, identity: str, *key: object) -> str:
+        return f"{private_key('user', identity)}:{private_key('entry', identity, *map(str, key))}"
+
+    async def get(self, cookies: dict, *key: object) -> bytes | None:
+        """Cached response for `key`, if it was fetched with the same user's cookies."""
+        identity = self._identity(cookies)
+        token = await self.store.get(self._key(identity, *key))
+
+        data = decrypt(private_cipher("private", identity), token) if token else None
+        if data is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return data
+
+    async def set(self, cookies: dict, *key: object, value: bytes):
+        identity = self._identity(cookies)
+        token = private_cipher("private", identity).encrypt(value)
+        await self.store.set(self._key(identity, *key), token, self.ttl)
+
+    async def metrics(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "bytes": await self.store.size(),
+            "max_bytes": self.store.max_bytes,
+        }
+
+
+_store = (
+    create_store("private", config.PRIVATE_CACHE_MAX_BYTES, config.PRIVATE_CACHE_TTL)
+    if config.PRIVATE_CACHE
+    else None
+)
+private_cache: Optional[PrivateCache] = (
+    PrivateCache(_store, config.PRIVATE_CACHE_TTL) if _store else None
+)
@@ -0,0 +1,47 @@
+import asyncio
+import time
+
+
+class TokenBucket:
+    """Token bucket rate limiter.
+
+    Consumers may take more tokens than are available, driving the bucket negative, and then sleep off the debt. Later consumers inherit the debt, so waiters are served roughly in arrival order.
+
+    Args:
+        rate (float): Tokens added per second.
+        capacity (float): Maximum tokens held, i.e. the allowed burst.
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def set_rate(self, rate: float, capacity: float):
+        """Change the rate and burst. Tokens accrued so far are kept, at the old rate."""
+        self._refill()
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = min(self.tokens, capacity)
+
+    def delay(self, amount: float = 1) -> float:
+        """Take `amount` tokens, returning the seconds to wait before using them."""
+        self._refill()
+        self.tokens -= amount
+        return max(0.0, -self.tokens / self.rate)
+
+    async def consume(self, amount: float = 1):
+        if delay := self.delay(amount):
+            await asyncio.sleep(delay)
+
+    @property
+    def idle_for(self) -> float:
+        """Seconds since the bucket was last used."""
+        return time.monotonic() - self.updated
@@ -0,0 +1,253 @@
+from __future__ import annotations
+
+import asyncio
+import pickle
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import asynccontextmanager
+from multiprocessing import get_context
+from typing import AsyncIterator, Callable, Optional, TypeVar
+
+from .exceptions import BuildQueueFullError
+from .generators import (
+    EPUBGenerator,
+    EPUBStreamWriter,
+    MOBIGenerator,
+    PDFGenerator,
+    pdf_exiftool,
+    pdf_resources,
+)
+from .logs import logger
+from .models import Story
+from .vars import config
+
+T = TypeVar("T")
+
+# Work done in the pool on behalf of builds: parsing story zips and processing images.
+TASK_KINDS = ("parse", "images")
+
+
+def build_book(
+    format: str,
+    metadata: Story,
+    parts: list[str],
+    cover: bytes,
+    images: list[list[bytes | None]],
+    author_image: Optional[bytes] = None,
+) -> bytes:
+    """Compile a book and return its bytes. Runs in a worker process, so every argument must be picklable."""
+    match format:
+        case "epub":
+            book = EPUBGenerator(metadata, parts, cover, images)
+        case "pdf":
+            book = PDFGenerator(
+                metadata,
+                parts,
+                cover,
+                images,
+                author_image,  # type: ignore
+                chunk_chapters=config.PDF_CHUNK_CHAPTERS,
+                metadata_writer=config.PDF_METADATA_WRITER,
+            )
+        case "mobi":
+            book = MOBIGenerator(
+                metadata,
+                parts,
+                cover,
+                images,
+                converter=config.MOBI_CONVERTER,
+                timeout=config.MOBI_CONVERT_TIMEOUT,
+                max_jobs=config.MOBI_WORKER_MAX_JOBS,
+            )
+        case _:
+            raise ValueError(f"Unknown format {format!r}.")
+
+    book.compile()
+
+    return book.dump().getvalue()
+
+
+def write_epub(
+    path: str, metadata: Story, cover: bytes, chapters: list[tuple[int, str]]
+):
+    """Write an EPUB to `path` with EPUBStreamWriter. Runs in a worker process.
+
+    Args:
+        path (str): Output path.
+        metadata (Story): Story Metadata.
+        cover (bytes): Cover image.
+        chapters (list[tuple[int, str]]): Index of each chapter, and the path of its pickled HTML and images. Loaded one at a time, so only the chapter being written is held in memory.
+    """
+    with open(path, "wb") as output:
+        writer = EPUBStreamWriter(metadata, output)
+        writer.add_cover(cover)
+        for idx, chapter_path in chapters:
+            with open(chapter_path, "rb") as file:
+                html, images = pickle.load(file)
+            writer.add_chapter(idx, metadata["parts"][idx], html, images)
+        writer.close()
+
+
+def warm_worker():
+    """Load rendering state before a worker's first build, rather than during it."""
+    if config.BUILD_WARM_PDF:
+        pdf_resources()
+        if config.PDF_METADATA_WRITER == "exiftool":
+            pdf_exiftool()
+
+
+class BuildScheduler:
+    """Run book builds in a process pool, keeping CPU-bound rendering off the event loop.
+
+    Tasks that builds need along the way (see TASK_KINDS) share the pool. They're never rejected, as their build was already admitted, but at most `workers` of each kind run at once so one illustrated book can't fill the pool's queue ahead of other builds.
+
+    If a worker dies, e.g. killed for using too much memory, the pool is broken for every task in it. It's replaced, and the tasks it took down are retried once, each in a process of its own, so only the task that killed the worker fails.
+
+    Args:
+        workers (int): Worker processes.
+        queue_depth (int): Builds allowed to be running or waiting at once. Further builds raise BuildQueueFullError.
+        format_limits (dict[str, int]): Concurrent builds allowed per format.
+        retry_after (int): Seconds clients are told to wait when the queue is full.
+    """
+
+    def __init__(
+        self,
+        workers: int,
+        queue_depth: int,
+        format_limits: dict[str, int],
+        retry_after: int,
+    ):
+        self.workers = workers
+        self.queue_depth = queue_depth
+        self.format_limits = format_limits
+        self.retry_after = retry_after
+
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._semaphores: dict[str, asyncio.Semaphore] = {}
+        self._queued: dict[str, int] = dict.fromkeys([*format_limits, *TASK_KINDS], 0)
+        self._running: dict[str, int] = dict.fromkeys([*format_limits, *TASK_KINDS], 0)
+
+    @staticmethod
+    def _pool(workers: int) -> ProcessPoolExecutor:
+        # fork would copy the event loop, open sockets and locks held by other threads.
+        return ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=get_context("spawn"),
+            initializer=warm_worker,
+        )
+
+    @property
+    def executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            self._executor = self._pool(self.workers)
+            logger.info(f"Started build pool with {self.workers} workers")
+
+        return self._executor
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def _discard(self, executor: ProcessPoolExecutor):
+        if self._executor is executor:
+            logger.warning("Build pool broken, starting a new one")
+            self._executor = None
+            executor.shutdown(wait=False)
+
+    def _semaphore(self, kind: str) -> asyncio.Semaphore:
+        # Created lazily, so they bind to the running loop.
+        if kind not in self._semaphores:
+            limit = self.format_limits.get(kind, self.workers)
+            self._semaphores[kind] = asyncio.Semaphore(limit)
+        return self._semaphores[kind]
+
+    @property
+    def pending(self) -> int:
+        """Builds running or waiting."""
+        return sum(
+            self._queued[format] + self._running[format]
+            for format in self.format_limits
+        )
+
+    @asynccontextmanager
+    async def _slot(self, kind: str) -> AsyncIterator[None]:
+        self._queued[kind] += 1
+        started = False
+        try:
+            async with self._semaphore(kind):
+                self._queued[kind] -= 1
+                self._running[kind] += 1
+                started = True
+                yield
+        finally:
+            if started:
+                self._running[kind] -= 1
+            else:
+                self._queued[kind] -= 1
+
+    async def _run(self, fn: Callable[..., T], *args) -> T:
+        loop = asyncio.get_running_loop()
+        executor = self.executor
+        try:
+            return await loop.run_in_executor(executor, fn, *args)
+        except BrokenProcessPool:
+            self._discard(executor)
+
+        isolated = self._pool(1)
+        try:
+            return await loop.run_in_executor(isolated, fn, *args)
+        finally:
+            isolated.shutdown(wait=False)
+
+    async def submit(self, kind: str, fn: Callable[..., T], *args) -> T:
+        """Run a task for a build that's already under way, `kind` being one of TASK_KINDS."""
+        async with self._slot(kind):
+            return await self._run(fn, *args)
+
+    async def run(self, format: str, fn: Callable[..., T], *args) -> T:
+        """Queue a build of `format`, running `fn(*args)` in the pool, and wait for its result.
+
+        Raises:
+            BuildQueueFullError: `queue_depth` builds are already pending.
+        """
+        if self.pending >= self.queue_depth:
+            logger.warning(f"Build queue full, rejecting {format} build")
+            raise BuildQueueFullError(self.retry_after)
+
+        async with self._slot(format):
+            return await self._run(fn, *args)
+
+    async def build(
+        self,
+        format: str,
+        metadata: Story,
+        parts: list[str],
+        cover: bytes,
+        images: list[list[bytes | None]],
+        author_image: Optional[bytes] = None,
+    ) -> bytes:
+        """Queue a build and wait for the book's bytes. See `run`."""
+        return await self.run(
+            format, build_book, format, metadata, parts, cover, images, author_image
+        )
+
+    def metrics(self) -> dict:
+        return {
+            "workers": self.workers,
+            "queue_depth": self.queue_depth,
+            "queued": dict(self._queued),
+            "running": dict(self._running),
+        }
+
+
+scheduler = BuildScheduler(
+    workers=config.BUILD_WORKERS,
+    queue_depth=config.BUILD_QUEUE_DEPTH,
+    format_limits={
+        "epub": config.BUILD_LIMIT_EPUB,
+        "pdf": config.BUILD_LIMIT_PDF,
+        "mobi": config.BUILD_LIMIT_MOBI,
+    },
+    retry_after=config.BUILD_RETRY_AFTER,
+)
@@ -0,0 +1,100 @@
+from __future__ import annotations
+
+import json
+import time
+from typing import Optional
+
+from .create_book import fetch_session
+from .crypto import decrypt, private_cipher, private_key
+from .singleflight import SingleFlight
+from .storage import BlobStore, create_store
+from .vars import config
+
+
+class SessionCache:
+    """Wattpad login cookies, reused until they expire so repeated downloads with the same credentials log in once.
+
+    Entries are keyed by a salted hash of the credentials and encrypted with a key derived from them, so the store reveals neither credentials nor usable cookies. An entry lasts until its first cookie expires, at most `ttl` seconds. Logins are shared by concurrent requests with the same credentials.
+
+    Args:
+        store (Optional[BlobStore]): Backend for encrypted sessions. None only shares concurrent logins.
+        ttl (int): Longest a session is reused, in seconds.
+    """
+
+    def __init__(self, store: Optional[BlobStore], ttl: int):
+        self.store = store
+        self.ttl = ttl
+
+        self._logins: SingleFlight[dict] = SingleFlight()
+
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    async def _get(self, key: str, username: str, password: str) -> dict | None:
+        if not self.store or not (token := await self.store.get(key)):
+            return None
+
+        data = decrypt(private_cipher(username.lower(), password), token)
+        if data is None:
+            return None
+
+        session = json.loads(data)
+        if session["expires"] <= time.time():
+            return None
+        return session["cookies"]
+
+    async def _login(self, key: str, username: str, password: str) -> dict:
+        cookies, expires = await fetch_session(username, password)
+
+        ttl = int(min(self.ttl, expires - time.time() if expires else self.ttl))
+        if self.store and ttl > 0:
+            session = {"cookies": cookies, "expires": time.time() + ttl}
+            token = private_cipher(username.lower(), password).encrypt(
+                json.dumps(session).encode()
+            )
+            await self.store.set(key, token, ttl)
+
+        return cookies
+
+    async def login(self, username: str, password: str) -> tuple[dict, bool]:
+        """Authorization cookies for the credentials, and whether they came from the cache.
+
+        Raises:
+            ValueError: The credentials were rejected, see `fetch_session`.
+        """
+        key = private_key("session", username.lower(), password)
+
+        if cookies := await self._get(key, username, password):
+            self.hits += 1
+            return cookies, True
+
+        self.misses += 1
+        cookies = await self._logins.do(
+            key, lambda: self._login(key, username, password)
+        )
+        return cookies, False
+
+    async def invalidate(self, username: str, password: str, cookies: dict):
+        """Forget `cookies` after Wattpad rejected them. A newer session, logged in by a concurrent request, is kept."""
+        key = private_key("session", username.lower(), password)
+
+        if self.store and await self._get(key, username, password) == cookies:
+            self.invalidations += 1
+            await self.store.delete(key)
+
+    def metrics(self) -> dict:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "invalidations": self.invalidations,
+            "logins": self._logins.metrics(),
+        }
+
+
+session_cache = SessionCache(
+    create_store("sessions", config.SESSION_CACHE_MAX_BYTES, config.SESSION_CACHE_TTL)
+    if config.SESSION_CACHE
+    else None,
+    config.SESSION_CACHE_TTL,
+)
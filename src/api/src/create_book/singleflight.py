@@ -0,0 +1,50 @@
+import asyncio
+from typing import Awaitable, Callable, Generic, TypeVar
+
+T = TypeVar("T")
+
+
+class SingleFlight(Generic[T]):
+    """Deduplicate concurrent work sharing a key.
+
+    The first caller for a key starts the work as a task; callers arriving before it finishes await the same task. The task is shielded, so a caller being cancelled (e.g. the client disconnecting) doesn't cancel the work for everyone else.
+    """
+
+    def __init__(self):
+        self._tasks: dict[str, asyncio.Task[T]] = {}
+
+        self.started = 0
+        self.joined = 0  # Callers that attached to work already in flight
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._tasks
+
+    def __len__(self) -> int:
+        return len(self._tasks)
+
+    async def do(self, key: str, work: Callable[[], Awaitable[T]]) -> T:
+        """Run `work`, or wait for the in-flight run for `key`."""
+        task = self._tasks.get(key)
+        if task is None:
+            task = asyncio.ensure_future(work())
+            self._tasks[key] = task
+            task.add_done_callback(lambda done: self._finish(key, done))
+            self.started += 1
+        else:
+            self.joined += 1
+
+        return await asyncio.shield(task)
+
+    def metrics(self) -> dict:
+        return {
+            "in_flight": len(self._tasks),
+            "started": self.started,
+            "joined": self.joined,
+        }
+
+    def _finish(self, key: str, task: asyncio.Task[T]):
+        if self._tasks.get(key) is task:
+            del self._tasks[key]
+
+        if not task.cancelled():
+            task.exception()  # Retrieved here in case every caller went away
@@ -0,0 +1,337 @@
+from __future__ import annotations
+
+import asyncio
+import os
+import shutil
+import threading
+import time
+from hashlib import sha256
+from io import BytesIO
+from pathlib import Path
+from tempfile import gettempdir
+from typing import BinaryIO, Optional
+from uuid import uuid4
+
+from redis.asyncio import Redis
+
+from .config import CacheTypes
+from .logs import logger
+from .vars import config
+
+RESCAN_INTERVAL = 60  # seconds, a file store recounts its directory at least this often, picking up other processes' writes
+EVICT_TO = 0.9  # Fraction of max_bytes a file store evicts down to, so a full store isn't rescanned on every write
+
+
+class BlobStore:
+    """Size-bounded byte store. Least-recently-used entries are evicted once `max_bytes` is exceeded.
+
+    Args:
+        namespace (str): Keeps stores sharing a backend apart.
+        max_bytes (int): Total size of stored values before eviction starts.
+        ttl (Optional[int]): Seconds before an entry expires. None keeps entries until evicted.
+    """
+
+    def __init__(self, namespace: str, max_bytes: int, ttl: Optional[int]):
+        self.namespace = namespace
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+
+    async def get(self, key: str) -> bytes | None:
+        """Return the stored value, marking it as recently used."""
+        raise NotImplementedError
+
+    async def set(self, key: str, value: bytes, ttl: Optional[int] = None):
+        """Store a value, evicting older entries if the store is over capacity. `ttl` overrides the store's default."""
+        raise NotImplementedError
+
+    async def open(self, key: str) -> BinaryIO | None:
+        """Return the stored value as a readable file object, marking it as recently used."""
+        value = await self.get(key)
+        return BytesIO(value) if value is not None else None
+
+    async def set_file(self, key: str, file: BinaryIO, ttl: Optional[int] = None):
+        """Store the contents of a file object, read from its current position."""
+        await self.set(key, await asyncio.to_thread(file.read), ttl)
+
+    async def delete(self, key: str):
+        raise NotImplementedError
+
+    async def size(self) -> int:
+        """Total bytes currently stored."""
+        raise NotImplementedError
+
+
+class FileBlobStore(BlobStore):
+    """Store values as files in a directory. Access time tracks recency, modification time tracks age.
+
+    A running byte total is kept, so the directory is only scanned when the total crosses `max_bytes`, or every RESCAN_INTERVAL seconds. Entries may be removed at any time by another process sharing the directory, they're skipped.
+    """
+
+    def __init__(self, directory: Path, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.directory = directory
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+        self._lock = asyncio.Lock()
+        self._bytes: Optional[int] = None  # Counted by the first scan
+        self._scanned = 0.0
+        self._bytes_lock = threading.Lock()  # Writes are accounted from worker threads
+
+    def _account(self, delta: int):
+        with self._bytes_lock:
+            if self._bytes is not None:
+                self._bytes += delta
+
+    def _remove(self, path: Path):
+        """Remove an entry and its expiry sidecar, if they still exist."""
+        stat = _stat(path)
+        if stat and _unlink(path):
+            self._account(-stat.st_size)
+        _unlink(path.with_suffix(".expiry"))
+
+    def path(self, key: str) -> Path:
+        # Keys may contain characters that aren't valid in filenames.
+        return self.directory / sha256(key.encode()).hexdigest()
+
+    def _expired(self, path: Path, now: float) -> bool:
+        if not self.ttl:
+            return False
+
+        stat = path.stat()
+        expires_at = stat.st_mtime + self.ttl
+        if expiry := _read_expiry(path):
+            expires_at = expiry
+
+        return expires_at < now
+
+    def _get(self, key: str) -> bytes | None:
+        path = self.path(key)
+        now = time.time()
+
+        try:
+            if self._expired(path, now):
+                self._remove(path)
+                return None
+
+            value = path.read_bytes()
+            os.utime(path, (now, path.stat().st_mtime))  # Mark as recently used
+        except FileNotFoundError:
+            return None
+
+        return value
+
+    def _open(self, key: str) -> BinaryIO | None:
+        path = self.path(key)
+        now = time.time()
+
+        try:
+            if self._expired(path, now):
+                self._remove(path)
+                return None
+
+            file = path.open("rb")  # Stays readable if evicted while open
+            os.utime(path, (now, path.stat().st_mtime))  # Mark as recently used
+        except FileNotFoundError:
+            return None
+
+        return file
+
+    def _set(self, key: str, value: bytes | BinaryIO, ttl: Optional[int]):
+        path = self.path(key)
+        temp_path = path.with_name(f"{path.name}.{uuid4().hex}.tmp")
+
+        if isinstance(value, bytes):
+            temp_path.write_bytes(value)
+            size = len(value)
+        else:
+            with temp_path.open("wb") as writer:
+                shutil.copyfileobj(value, writer)
+                size = writer.tell()
+
+        replaced = _stat(path)
+        os.replace(temp_path, path)  # Readers never see a partial file
+        self._account(size - (replaced.st_size if replaced else 0))
+
+        if ttl and ttl != self.ttl:
+            path.with_suffix(".expiry").write_text(str(time.time() + ttl))
+        else:
+            _unlink(path.with_suffix(".expiry"))
+
+    def _scan(self) -> list[tuple[os.stat_result, Path]]:
+        entries = []
+        for path in self.directory.iterdir():
+            if path.suffix:  # Skip expiry sidecars and partial writes
+                continue
+            if stat := _stat(path):
+                entries.append((stat, path))
+
+        return entries
+
+    def _evict(self):
+        """Recount the directory. If it's over `max_bytes`, remove least recently used entries until it's under EVICT_TO of it."""
+        entries = self._scan()
+        total = sum(stat.st_size for stat, _ in entries)
+
+        if total > self.max_bytes:
+            for stat, path in sorted(entries, key=lambda entry: entry[0].st_atime):
+                if _unlink(path):
+                    total -= stat.st_size
+                _unlink(path.with_suffix(".expiry"))
+                if total <= self.max_bytes * EVICT_TO:
+                    break
+
+            logger.info(f"Evicted {self.namespace} entries, {total} bytes remain")
+
+        with self._bytes_lock:
+            self._bytes = total
+        self._scanned = time.monotonic()
+
+    async def _evict_if_full(self):
+        async with self._lock:
+            if (
+                self._bytes is None
+                or self._bytes > self.max_bytes
+                or time.monotonic() - self._scanned > RESCAN_INTERVAL
+            ):
+                await asyncio.to_thread(self._evict)
+
+    async def get(self, key: str) -> bytes | None:
+        return await asyncio.to_thread(self._get, key)
+
+    async def open(self, key: str) -> BinaryIO | None:
+        return await asyncio.to_thread(self._open, key)
+
+    async def set(self, key: str, value: bytes, ttl: Optional[int] = None):
+        await asyncio.to_thread(self._set, key, value, ttl)
+        await self._evict_if_full()
+
+    async def set_file(self, key: str, file: BinaryIO, ttl: Optional[int] = None):
+        # Copied in chunks, never held in memory as a whole.
+        await asyncio.to_thread(self._set, key, file, ttl)
+        await self._evict_if_full()
+
+    async def delete(self, key: str):
+        await asyncio.to_thread(self._remove, self.path(key))
+
+    async def size(self) -> int:
+        await self._evict_if_full()  # Recounts the directory, if the total is stale
+        return self._bytes or 0
+
+
+class RedisBlobStore(BlobStore):
+    """Store values in Redis, with a sorted set of access times for LRU eviction and a running byte total."""
+
+    def __init__(self, redis: Redis, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.redis = redis
+
+        self._lru_key = f"{self.namespace}:lru"
+        self._sizes_key = f"{self.namespace}:sizes"
+        self._total_key = f"{self.namespace}:bytes"
+
+    def _key(self, key: str) -> str:
+        return f"{self.namespace}:value:{key}"
+
+    async def get(self, key: str) -> bytes | None:
+        value = await self.redis.get(self._key(key))
+        if value is None:
+            await self._forget(key)  # Expired via TTL
+            return None
+
+        await self.redis.zadd(self._lru_key, {key: time.time()})
+        return value
+
+    async def set(self, key: str, value: bytes, ttl: Optional[int] = None):
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.set(self._key(key), value, ex=ttl or self.ttl)
+            pipe.zadd(self._lru_key, {key: time.time()})
+            pipe.hget(self._sizes_key, key)
+            pipe.hset(self._sizes_key, key, len(value))
+            _, _, previous_size, _ = await pipe.execute()
+
+        await self.redis.incrby(self._total_key, len(value) - int(previous_size or 0))
+        await self._evict()
+
+    async def _forget(self, key: str):
+        """Drop a key from the size and recency indexes."""
+        size = await self.redis.hget(self._sizes_key, key)
+
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.zrem(self._lru_key, key)
+            pipe.hdel(self._sizes_key, key)
+            if size is not None:
+                pipe.decrby(self._total_key, int(size))
+            await pipe.execute()
+
+    async def _evict(self):
+        while int(await self.redis.get(self._total_key) or 0) > self.max_bytes:
+            oldest = await self.redis.zrange(self._lru_key, 0, 0)
+            if not oldest:
+                break
+
+            key = oldest[0].decode()
+            await self.redis.delete(self._key(key))
+            await self._forget(key)
+
+    async def delete(self, key: str):
+        await self.redis.delete(self._key(key))
+        await self._forget(key)
+
+    async def size(self) -> int:
+        return int(await self.redis.get(self._total_key) or 0)
+
+
+def _read_expiry(path: Path) -> float | None:
+    try:
+        return float(path.with_suffix(".expiry").read_text())
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def _stat(path: Path) -> os.stat_result | None:
+    """Stat a file that may be removed concurrently."""
+    try:
+        return path.stat()
+    except FileNotFoundError:
+        return None
+
+
+def _unlink(path: Path) -> bool:
+    """Remove a file that may be removed concurrently. Returns whether this call removed it."""
+    try:
+        path.unlink()
+    except FileNotFoundError:
+        return False
+    return True
+
+
+_redis: Optional[Redis] = None
+
+
+def redis_client() -> Redis:
+    """Client for REDIS_CONNECTION_URL, shared by everything stored in Redis."""
+    global _redis
+
+    if _redis is None:
+        _redis = Redis.from_url(config.REDIS_CONNECTION_URL)
+
+    return _redis
+
+
+def create_store(
+    namespace: str, max_bytes: int, ttl: Optional[int]
+) -> Optional[BlobStore]:
+    """Create a store on the configured cache backend. Returns None if caching is disabled."""
+    if not config.USE_CACHE:
+        return None
+
+    match config.CACHE_TYPE:
+        case CacheTypes.file:
+            store = FileBlobStore(
+                Path(gettempdir()) / "wpd" / namespace, namespace, max_bytes, ttl
+            )
+        case CacheTypes.redis:
+            store = RedisBlobStore(redis_client(), f"wpd-{namespace}", max_bytes, ttl)
+
+    logger.info(f"Using {store=} for {namespace}")
+    return store
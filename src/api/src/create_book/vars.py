@@ -1,7 +1,9 @@
 from aiohttp_client_cache import FileBackend, RedisBackend
 from dotenv import load_dotenv
 
+from .clients import ClientManager
 from .config import CacheTypes, Config
+from .governor import create_governor
 from .logs import logger
 
 headers = {
@@ -26,3 +28,17 @@ else:
     cache = None
 
 logger.info(f"Using {cache=}")
+
+governor = create_governor(config)
+
+clients = ClientManager(
+    headers=headers,
+    cache=cache,
+    api_limit=config.API_POOL_LIMIT,
+    api_limit_per_host=config.API_POOL_LIMIT_PER_HOST,
+    image_limit=config.IMAGE_POOL_LIMIT,
+    image_limit_per_host=config.IMAGE_POOL_LIMIT_PER_HOST,
+    keepalive_timeout=config.POOL_KEEPALIVE_TIMEOUT,
+    dns_cache_ttl=config.DNS_CACHE_TTL,
+    governor=governor,
+)
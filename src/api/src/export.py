@@ -0,0 +1,238 @@
+"""Export many stories to a directory, for offline mirrors and scheduled archives.
+
+Stories already exported are skipped unless they've changed since. Exports are tracked in a manifest in the output directory, saved after every book, so an interrupted export resumes where it stopped. Books are written atomically, a directory never holds a partial book.
+
+Usage (from src/api/src):
+    python export.py stories.txt --output export [--format epub] [--images] [--concurrency 4] [--workers 4]
+
+`stories.txt` holds one story ID per line. Set WATTPAD_PASSWORD along with --username to export as a logged in user.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import sys
+import time
+from pathlib import Path
+from tempfile import NamedTemporaryFile
+from typing import BinaryIO, Callable, Optional
+
+from create_book import clients, fetch_cookies, fetch_story, logger, slugify
+from create_book.artifacts import artifact_key
+from create_book.jobs import describe_error
+from create_book.pipeline import build_book
+from create_book.scheduler import scheduler
+from create_book.vars import config
+
+MANIFEST_NAME = "manifest.json"
+UMASK = os.umask(0)  # Only readable by setting it, restored straight away
+os.umask(UMASK)
+
+
+def read_ids(path: Path) -> list[int]:
+    """Story IDs, one per line, without duplicates. Blank lines and #-comments are ignored."""
+    ids = []
+    for line in path.read_text().splitlines():
+        if line := line.split("#", 1)[0].strip():
+            ids.append(int(line))
+
+    return list(dict.fromkeys(ids))
+
+
+def write_atomic(path: Path, write: Callable[[BinaryIO], object]):
+    """Write `path` through a temporary file beside it, then move it into place. Readers see the old file or the new one, never a partial one.
+
+    The file gets the usual permissions for new files, rather than the temporary file's owner-only ones, so mirrors can be served and synced by other users.
+    """
+    file = NamedTemporaryFile(
+        dir=path.parent, prefix=f".{path.name}.", suffix=".tmp", delete=False
+    )
+    try:
+        with file:
+            write(file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.chmod(file.name, 0o666 & ~UMASK)
+        os.replace(file.name, path)
+    except BaseException:
+        Path(file.name).unlink(missing_ok=True)
+        raise
+
+
+class Manifest:
+    """Stories exported to a directory, by story ID.
+
+    Each entry holds the book's artifact key, which changes with the story's `modifyDate`, its parts, the format and image settings, so a story is only built again if its book would differ.
+
+    Args:
+        path (Path): Manifest file, created on the first save.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.entries: dict[str, dict] = (
+            json.loads(path.read_text()) if path.exists() else {}
+        )
+
+    def current(self, story_id: int, key: str) -> bool:
+        """Whether the story's book was exported with this key, and is still there."""
+        entry = self.entries.get(str(story_id))
+        return bool(
+            entry
+            and entry["key"] == key
+            and (self.path.parent / entry["filename"]).exists()
+        )
+
+    def record(self, story_id: int, key: str, modify_date: str, filename: str):
+        """Save an exported book, removing the story's previous book if it was renamed."""
+        previous = self.entries.get(str(story_id))
+        self.entries[str(story_id)] = {
+            "key": key,
+            "modifyDate": modify_date,
+            "filename": filename,
+            "exported": time.time(),
+        }
+        write_atomic(
+            self.path,
+            lambda file: file.write(json.dumps(self.entries, indent=2).encode()),
+        )
+
+        if previous and previous["filename"] != filename:
+            (self.path.parent / previous["filename"]).unlink(missing_ok=True)
+
+
+class Throughput:
+    """Prints each story's outcome, with books built per minute so far."""
+
+    def __init__(self, total: int):
+        self.total = total
+        self.started = time.monotonic()
+
+        self.exported = 0
+        self.unchanged = 0
+        self.failed = 0
+
+    @property
+    def books_per_minute(self) -> float:
+        minutes = (time.monotonic() - self.started) / 60
+        return self.exported / minutes if minutes else 0.0
+
+    def report(self, story_id: int, outcome: str):
+        done = self.exported + self.unchanged + self.failed
+        print(
+            f"[{done}/{self.total}] {story_id}: {outcome} ({self.books_per_minute:.1f} books/min)",
+            flush=True,
+        )
+
+    def summary(self) -> str:
+        return f"{self.exported} exported, {self.unchanged} unchanged, {self.failed} failed in {time.monotonic() - self.started:.0f}s ({self.books_per_minute:.1f} books/min)"
+
+
+async def export(
+    story_ids: list[int],
+    output: Path,
+    format: str,
+    download_images: bool,
+    concurrency: int,
+    cookies: Optional[dict],
+) -> Throughput:
+    """Export every story to `output`, `concurrency` at a time."""
+    output.mkdir(parents=True, exist_ok=True)
+    manifest = Manifest(output / MANIFEST_NAME)
+    throughput = Throughput(len(story_ids))
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def export_story(story_id: int):
+        async with semaphore:
+            try:
+                metadata = await fetch_story(story_id, cookies)
+                key = artifact_key(metadata, format, download_images)
+                if manifest.current(story_id, key):
+                    throughput.unchanged += 1
+                    throughput.report(story_id, "unchanged")
+                    return
+
+                filename = f"{slugify(metadata['title'])}_{story_id}{'_images' if download_images else ''}.{format}"
+                with await build_book(
+                    metadata, story_id, format, download_images, cookies
+                ) as book_file:
+                    await asyncio.to_thread(
+                        write_atomic,
+                        output / filename,
+                        lambda file: shutil.copyfileobj(book_file, file),
+                    )
+                manifest.record(story_id, key, metadata["modifyDate"], filename)
+            except Exception as exception:
+                logger.exception(f"Failed to export {story_id=}")
+                throughput.failed += 1
+                throughput.report(story_id, f"failed, {describe_error(exception)}")
+            else:
+                throughput.exported += 1
+                throughput.report(story_id, f"exported {filename}")
+
+    await asyncio.gather(*[export_story(story_id) for story_id in story_ids])
+    return throughput
+
+
+async def run(args: argparse.Namespace) -> int:
+    try:
+        cookies = None
+        if args.username:
+            if not (password := os.environ.get("WATTPAD_PASSWORD")):
+                print("Set WATTPAD_PASSWORD to log in as --username.", file=sys.stderr)
+                return 2
+
+            try:
+                cookies = await fetch_cookies(args.username, password)
+            except Exception as exception:  # Rejected credentials raise ValueError
+                logger.exception("Failed to log in")
+                print(
+                    f"Couldn't log in as {args.username}, check the username and WATTPAD_PASSWORD ({exception}).",
+                    file=sys.stderr,
+                )
+                return 2
+
+        throughput = await export(
+            read_ids(args.ids),
+            args.output,
+            args.format,
+            args.images,
+            args.concurrency,
+            cookies,
+        )
+    finally:
+        await clients.close()
+
+    print(throughput.summary())
+    return 1 if throughput.failed else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("ids", type=Path, help="File of story IDs, one per line")
+    parser.add_argument("--output", type=Path, default=Path("export"))
+    parser.add_argument("--format", choices=["epub", "pdf", "mobi"], default="epub")
+    parser.add_argument("--images", action="store_true", help="Include chapter images")
+    parser.add_argument(
+        "--concurrency", type=int, default=4, help="Stories fetched and built at once"
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=config.BUILD_WORKERS,
+        help="Processes rendering books and cleaning parts",
+    )
+    parser.add_argument("--username", help="Export as this user, see WATTPAD_PASSWORD")
+    args = parser.parse_args()
+
+    # The build pool starts on first use, so it can still be resized. This process is the pool's only user.
+    scheduler.workers = args.workers
+    scheduler.format_limits = dict.fromkeys(scheduler.format_limits, args.workers)
+    scheduler.queue_depth = max(scheduler.queue_depth, args.concurrency)
+
+    try:
+        sys.exit(asyncio.run(run(args)))
+    finally:
+        scheduler.shutdown()
@@ -1,40 +1,65 @@
 """WattpadDownloader API Server."""
 
 import asyncio
+import hmac
+import shutil
+from contextlib import asynccontextmanager
 from enum import Enum
+from hashlib import sha256
+from io import SEEK_END, BytesIO
 from pathlib import Path
-from typing import Optional
-from zipfile import ZipFile
+from secrets import token_bytes
+from tempfile import NamedTemporaryFile, _TemporaryFileWrapper
+from typing import BinaryIO, Optional
 
 from aiohttp import ClientResponseError
-from bs4 import BeautifulSoup
 from eliot import start_action
-from fastapi import FastAPI, HTTPException, Request
+from fastapi import FastAPI, HTTPException, Request, Response
 from fastapi.responses import (
     FileResponse,
     HTMLResponse,
+    JSONResponse,
     RedirectResponse,
-    StreamingResponse,
 )
 from fastapi.staticfiles import StaticFiles
+from pydantic import BaseModel
 
 from create_book import (
-    EPUBGenerator,
-    MOBIGenerator,
-    PDFGenerator,
+    BuildQueueFullError,
+    MissingCoverError,
+    RateLimitedError,
     StoryNotFoundError,
     WattpadError,
-    fetch_cookies,
-    fetch_image,
+    clients,
     fetch_story,
-    fetch_story_content_zip,
     fetch_story_from_partId,
     logger,
     slugify,
 )
-from create_book.parser import clean_tree, fetch_tree_images
-
-app = FastAPI()
+from create_book.artifacts import artifact_key, artifact_store, builds
+from create_book.image_store import image_store
+from create_book.jobs import Job, Progress, describe_error, job_queue, job_store
+from create_book.models import Story
+from create_book.part_store import part_store
+from create_book.pipeline import build_book
+from create_book.private_cache import private_cache
+from create_book.scheduler import scheduler
+from create_book.sessions import session_cache
+from create_book.singleflight import SingleFlight
+from create_book.vars import config, governor
+from responses import archive_response, book_response, etag_matches
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await clients.start()
+    yield
+    await job_queue.close()
+    await clients.close()
+    scheduler.shutdown()
+
+
+app = FastAPI(lifespan=lifespan)
 BUILD_PATH = Path(__file__).parent / "build"
 
 
@@ -81,6 +106,13 @@ class DownloadFormat(Enum):
     mobi = "mobi"
 
 
+MEDIA_TYPES = {
+    DownloadFormat.epub: "application/epub+zip",
+    DownloadFormat.pdf: "application/pdf",
+    DownloadFormat.mobi: "application/x-mobipocket-ebook",
+}
+
+
 class DownloadMode(Enum):
     story = "story"
     part = "part"
@@ -122,8 +154,207 @@ def download_wp_error_handler(request: Request, exception: WattpadError):
         )
 
 
+@app.exception_handler(RateLimitedError)
+def rate_limited_handler(request: Request, exception: RateLimitedError):
+    # Wattpad asked us to slow down for longer than a request can wait
+    return HTMLResponse(
+        status_code=429,
+        content='The website is overloaded. Please try again in a few minutes. Support is available on the <a href="https://discord.gg/P9RHC4KCwd" target="_blank">Discord</a>',
+        headers={"Retry-After": str(exception.retry_after)},
+    )
+
+
+@app.exception_handler(BuildQueueFullError)
+def build_queue_full_handler(request: Request, exception: BuildQueueFullError):
+    return HTMLResponse(
+        status_code=429,
+        content='Too many books are being generated right now. Please try again in a minute. Support is available on the <a href="https://discord.gg/P9RHC4KCwd" target="_blank">Discord</a>',
+        headers={"Retry-After": str(exception.retry_after)},
+    )
+
+
+@app.exception_handler(MissingCoverError)
+def missing_cover_handler(request: Request, exception: MissingCoverError):
+    return HTMLResponse(
+        status_code=422,
+        content='This story\'s cover could not be downloaded. Please try again in a few minutes. Support is available on the <a href="https://discord.gg/P9RHC4KCwd" target="_blank">Discord</a>',
+    )
+
+
+class DownloadRequestError(Exception):
+    """Reject a download request with an HTML message."""
+
+    def __init__(self, status_code: int, content: str):
+        super().__init__(content)
+        self.status_code = status_code
+        self.content = content
+
+
+@app.exception_handler(DownloadRequestError)
+def download_request_error_handler(request: Request, exception: DownloadRequestError):
+    return HTMLResponse(status_code=exception.status_code, content=exception.content)
+
+
+# Identical requests arriving together share one login, metadata fetch and build.
+metadata_flights: SingleFlight[tuple[int, Story, Optional[dict]]] = SingleFlight()
+private_builds: SingleFlight[_TemporaryFileWrapper] = SingleFlight()
+# Books that can't be stored, kept for PRIVATE_BOOK_TTL so resumed downloads don't rebuild them. Keyed like `private_builds`.
+private_books: dict[str, _TemporaryFileWrapper] = {}
+_requester_salt = token_bytes(16)
+
+
+def requester_key(username: Optional[str], password: Optional[str]) -> str:
+    """Who a request is made as. Authenticated requests only coalesce with requests using the same credentials."""
+    if not (username and password):
+        return "anonymous"
+
+    # Salted per process, credentials can't be recovered from keys.
+    return hmac.new(
+        _requester_salt, f"{username.lower()}\0{password}".encode(), sha256
+    ).hexdigest()
+
+
+async def fetch_download_metadata(
+    download_id: int,
+    mode: DownloadMode,
+    username: Optional[str],
+    password: Optional[str],
+) -> tuple[int, Story, Optional[dict]]:
+    """Log in if credentials were given, and fetch the requested story's metadata. Shared by identical requests made as the same requester.
+
+    Returns:
+        tuple[int, Story, Optional[dict]]: Story ID, Story Metadata and authorization cookies.
+    """
+    return await metadata_flights.do(
+        f"{mode.value}|{download_id}|{requester_key(username, password)}",
+        lambda: _fetch_download_metadata(download_id, mode, username, password),
+    )
+
+
+async def _fetch_download_metadata(
+    download_id: int,
+    mode: DownloadMode,
+    username: Optional[str],
+    password: Optional[str],
+) -> tuple[int, Story, Optional[dict]]:
+    if username and not password or password and not username:
+        logger.error("Username with no Password or Password with no Username provided.")
+        raise DownloadRequestError(
+            422,
+            'Include both the username <u>and</u> password, or neither. Support is available on the <a href="https://discord.gg/P9RHC4KCwd" target="_blank">Discord</a>',
+        )
+
+    if not (username and password):
+        return *await _fetch_metadata(download_id, mode, None), None
+
+    # username and password are URL-Encoded by the frontend. FastAPI automatically decodes them.
+    try:
+        cookies, cached = await session_cache.login(username, password)
+    except ValueError:
+        logger.error("Invalid username or password.")
+        raise DownloadRequestError(
+            403,
+            'Incorrect Username and/or Password. Support is available on the <a href="https://discord.gg/P9RHC4KCwd" target="_blank">Discord</a>',
+        )
+
+    try:
+        return *await _fetch_metadata(download_id, mode, cookies), cookies
+    except ClientResponseError as exception:
+        if not (cached and exception.status in (401, 403)):
+            raise
+
+    # The cached session was revoked early, log in again.
+    logger.info("Cached session rejected, logging in again.")
+    await session_cache.invalidate(username, password, cookies)
+    cookies, _ = await session_cache.login(username, password)
+    return *await _fetch_metadata(download_id, mode, cookies), cookies
+
+
+async def _fetch_metadata(
+    download_id: int, mode: DownloadMode, cookies: Optional[dict]
+) -> tuple[int, Story]:
+    match mode:
+        case DownloadMode.story:
+            return download_id, await fetch_story(download_id, cookies)
+        case DownloadMode.part:
+            return await fetch_story_from_partId(download_id, cookies)
+
+
+def book_filename(
+    metadata: Story, story_id: int, format: DownloadFormat, download_images: bool
+) -> str:
+    return f"{slugify(metadata['title'])}_{story_id}{'_images' if download_images else ''}.{format.value}"
+
+
+async def obtain_book(
+    metadata: Story,
+    story_id: int,
+    format: DownloadFormat,
+    download_images: bool,
+    cookies: Optional[dict],
+    requester: str = "anonymous",
+    progress: Optional[Progress] = None,
+) -> tuple[BinaryIO, Optional[str]]:
+    """Serve a book from the artifact store, building and storing it if needed.
+
+    Concurrent requests for the same book share one build. Requests with cookies only share builds with the same `requester`, see `requester_key`. Books that can't be stored are shared as a temporary file instead, kept for PRIVATE_BOOK_TTL seconds so a resumed download reuses it.
+
+    Returns:
+        tuple[BinaryIO, Optional[str]]: File containing the book, and its artifact key if it's shared.
+    """
+    key = artifact_key(metadata, format.value, download_images)
+
+    if cookies or not artifact_store:
+        # Books built with cookies may contain paywalled content, never store them.
+        flight = f"{key}|{requester}"
+
+        def forget(book: _TemporaryFileWrapper):
+            if private_books.get(flight) is book:
+                del private_books[flight]
+
+        async def build() -> _TemporaryFileWrapper:
+            book = NamedTemporaryFile(prefix="wpd-book-")
+            with await build_book(
+                metadata, story_id, format.value, download_images, cookies, progress
+            ) as book_file:
+                await asyncio.to_thread(shutil.copyfileobj, book_file, book)
+                await asyncio.to_thread(book.flush)
+
+            if config.PRIVATE_BOOK_TTL:
+                private_books[flight] = book
+                asyncio.get_running_loop().call_later(
+                    config.PRIVATE_BOOK_TTL, forget, book
+                )
+            return book
+
+        book = private_books.get(flight) or await private_builds.do(flight, build)
+        # Every request reads through its own handle. The file is removed once the last reference to `book` goes.
+        return open(book.name, "rb"), None
+
+    if book_file := await artifact_store.open(key):
+        logger.info(f"Serving cached book ({story_id=}, {key=})")
+        return book_file, key
+
+    async def build_and_store():
+        with await build_book(
+            metadata, story_id, format.value, download_images, cookies, progress
+        ) as book_file:
+            await artifact_store.set_file(key, book_file)
+
+    await builds.do(key, build_and_store)
+    if book_file := await artifact_store.open(key):
+        return book_file, key
+
+    # Evicted as soon as it was stored, the cache is too small.
+    book_file = await build_book(
+        metadata, story_id, format.value, download_images, cookies, progress
+    )
+    return book_file, key
+
+
 @app.get("/download/{download_id}")
 async def handle_download(
+    request: Request,
     download_id: int,
     download_images: bool = False,
     mode: DownloadMode = DownloadMode.story,
@@ -138,95 +369,292 @@ async def handle_download(
         format=format,
         mode=mode,
     ):
-        if username and not password or password and not username:
-            logger.error(
-                "Username with no Password or Password with no Username provided."
-            )
-            return HTMLResponse(
-                status_code=422,
-                content='Include both the username <u>and</u> password, or neither. Support is available on the <a href="https://discord.gg/P9RHC4KCwd" target="_blank">Discord</a>',
-            )
-
-        if username and password:
-            # username and password are URL-Encoded by the frontend. FastAPI automatically decodes them.
-            try:
-                cookies = await fetch_cookies(username=username, password=password)
-            except ValueError:
-                logger.error("Invalid username or password.")
-                return HTMLResponse(
-                    status_code=403,
-                    content='Incorrect Username and/or Password. Support is available on the <a href="https://discord.gg/P9RHC4KCwd" target="_blank">Discord</a>',
-                )
-        else:
-            cookies = None
-
-        match mode:
-            case DownloadMode.story:
-                story_id = download_id
-                metadata = await fetch_story(story_id, cookies)
-            case DownloadMode.part:
-                story_id, metadata = await fetch_story_from_partId(download_id, cookies)
-
-        cover_data = await fetch_image(
-            metadata["cover"].replace("-256-", "-512-")
-        )  # Increase resolution
-        if not cover_data:
-            raise HTTPException(status_code=422)
-
-        story_zip = await fetch_story_content_zip(story_id, cookies)
-        archive = ZipFile(story_zip, "r")
-
-        part_trees: list[BeautifulSoup] = [
-            clean_tree(
-                part["title"], part["id"], archive.read(str(part["id"])).decode("utf-8")
-            )
-            for part in metadata["parts"]
-        ]
+        story_id, metadata, cookies = await fetch_download_metadata(
+            download_id, mode, username, password
+        )
 
-        images = (
-            [await fetch_tree_images(tree) for tree in part_trees]
-            if download_images
-            else []
+        book_file, key = await obtain_book(
+            metadata,
+            story_id,
+            format,
+            download_images,
+            cookies,
+            requester_key(username, password),
         )
 
-        match format:
-            case DownloadFormat.epub:
-                book = EPUBGenerator(metadata, part_trees, cover_data, images)
-                media_type = "application/epub+zip"
-            case DownloadFormat.pdf:
-                author_image = await fetch_image(
-                    metadata["user"]["avatar"].replace("-256-", "-512-")
-                )
-                if not author_image:
-                    raise HTTPException(status_code=422)
+        size = book_file.seek(0, SEEK_END)
+        book_file.seek(0)
 
-                book = PDFGenerator(
-                    metadata, part_trees, cover_data, images, author_image
-                )
-                media_type = "application/pdf"
-            case DownloadFormat.mobi:
-                book = MOBIGenerator(metadata, part_trees, cover_data, images)
-                media_type = "application/x-mobipocket-ebook"
+        return book_response(
+            request,
+            book_file,
+            size,
+            media_type=MEDIA_TYPES[format],
+            filename=book_filename(metadata, story_id, format, download_images),
+            etag=key,
+        )
 
-        logger.info(f"Retrieved story metadata and cover ({story_id=})")
 
-        book.compile()
+class StoryInfo(BaseModel):
+    """What the frontend previews before a download starts."""
+
+    id: int
+    title: str
+    author: str
+    cover: str
+    parts: int
+    completed: bool
+    mature: bool
+    paywalled: bool
+    modifyDate: str
+
+
+async def story_info_response(
+    request: Request, download_id: int, mode: DownloadMode
+) -> Response:
+    """A story's info, without fetching or building its book.
+
+    Metadata comes from the response cache, and is shared with concurrent downloads of the story. The ETag changes with the story's `modifyDate`, so clients revalidating with `If-None-Match` are answered with a 304 and no body.
+    """
+    story_id, metadata, _ = await fetch_download_metadata(download_id, mode, None, None)
+
+    etag = sha256(f"{story_id}|{metadata['modifyDate']}".encode()).hexdigest()
+    headers = {
+        "ETag": f'"{etag}"',
+        "Cache-Control": f"public, max-age={config.STORY_INFO_MAX_AGE}",
+    }
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+
+    info = StoryInfo(
+        id=story_id,
+        title=metadata["title"],
+        author=metadata["user"]["username"],
+        cover=metadata["cover"],
+        parts=len(metadata["parts"]),
+        completed=metadata["completed"],
+        mature=metadata["mature"],
+        paywalled=metadata["isPaywalled"],
+        modifyDate=metadata["modifyDate"],
+    )
+    return JSONResponse(info.model_dump(), headers=headers)
+
+
+@app.get("/story/{story_id}", response_model=StoryInfo)
+async def get_story_info(request: Request, story_id: int):
+    with start_action(action_type="story_info", story_id=story_id):
+        return await story_info_response(request, story_id, DownloadMode.story)
+
+
+@app.get("/part/{part_id}", response_model=StoryInfo)
+async def get_part_info(request: Request, part_id: int):
+    """Info of the story a part belongs to."""
+    with start_action(action_type="part_info", part_id=part_id):
+        return await story_info_response(request, part_id, DownloadMode.part)
+
+
+class BatchRequest(BaseModel):
+    download_ids: list[int]
+    download_images: bool = False
+    mode: DownloadMode = DownloadMode.story
+    format: DownloadFormat = DownloadFormat.epub
+    username: Optional[str] = None
+    password: Optional[str] = None
+
+
+@app.post("/batch")
+async def handle_batch(request: Request, batch_request: BatchRequest):
+    """Download several stories as one zip, streamed as each book finishes.
+
+    Books are built BATCH_CONCURRENCY at a time, sharing logins, metadata fetches, builds and stored books with every other request. Books that couldn't be built are listed in `errors.txt`, at the end of the archive.
+    """
+    download_ids = list(dict.fromkeys(batch_request.download_ids))
+    if not 0 < len(download_ids) <= config.BATCH_MAX_BOOKS:
+        raise DownloadRequestError(
+            422,
+            f'Include between 1 and {config.BATCH_MAX_BOOKS} stories. Support is available on the <a href="https://discord.gg/P9RHC4KCwd" target="_blank">Discord</a>',
+        )
 
-        book_buffer = book.dump()
+    format, download_images = batch_request.format, batch_request.download_images
+    username, password = batch_request.username, batch_request.password
+    requester = requester_key(username, password)
 
-        async def iterfile():
-            while chunk := book_buffer.read(512 * 4):  # 4 kb/s
-                await asyncio.sleep(0.1)  # throttle download speed
-                yield chunk
+    with start_action(
+        action_type="batch",
+        count=len(download_ids),
+        download_images=download_images,
+        format=format,
+        mode=batch_request.mode,
+    ):
+        # Fetched before responding, so bad credentials are rejected with an error status.
+        results = await asyncio.gather(
+            *[
+                fetch_download_metadata(
+                    download_id, batch_request.mode, username, password
+                )
+                for download_id in download_ids
+            ],
+            return_exceptions=True,
+        )
+        for result in results:
+            if isinstance(result, DownloadRequestError):
+                raise result
+
+    errors: list[str] = []
+    stories: dict[int, tuple[Story, Optional[dict]]] = {}
+    for download_id, result in zip(download_ids, results):
+        if isinstance(result, BaseException):
+            logger.error(f"Skipping {download_id=} in batch: {result!r}")
+            errors.append(f"{download_id}: {describe_error(result)}")  # type: ignore
+        else:
+            story_id, metadata, cookies = result
+            # Parts of one story are downloaded once
+            stories.setdefault(story_id, (metadata, cookies))
+
+    semaphore = asyncio.Semaphore(config.BATCH_CONCURRENCY)
+
+    async def build(
+        story_id: int, metadata: Story, cookies: Optional[dict]
+    ) -> tuple[str, BinaryIO]:
+        async with semaphore:
+            book_file, _ = await obtain_book(
+                metadata, story_id, format, download_images, cookies, requester
+            )
+        return book_filename(metadata, story_id, format, download_images), book_file
 
-        return StreamingResponse(
-            iterfile(),
-            media_type=media_type,
-            headers={
-                "Content-Disposition": f'attachment; filename="{slugify(metadata["title"])}_{story_id}{"_images" if download_images else ""}.{format.value}"',  # Thanks https://stackoverflow.com/a/72729058
-                "Content-Length": str(book_buffer.getbuffer().nbytes),
-            },
+    async def books():
+        tasks = {
+            asyncio.ensure_future(build(story_id, metadata, cookies)): story_id
+            for story_id, (metadata, cookies) in stories.items()
+        }
+        try:
+            # Yields the original tasks, in completion order.
+            async for task in asyncio.as_completed(tasks):
+                try:
+                    yield task.result()
+                except Exception as exception:
+                    logger.exception(f"Failed to build story_id={tasks[task]} in batch")
+                    errors.append(f"{tasks[task]}: {describe_error(exception)}")
+
+            if errors:
+                yield "errors.txt", BytesIO("\n".join(errors).encode("utf-8"))
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    return archive_response(request, books(), f"wattpad_{format.value}_books.zip")
+
+
+class JobRequest(BaseModel):
+    download_id: int
+    download_images: bool = False
+    mode: DownloadMode = DownloadMode.story
+    format: DownloadFormat = DownloadFormat.epub
+    username: Optional[str] = None
+    password: Optional[str] = None
+
+
+@app.post("/jobs", status_code=202)
+async def create_job(job_request: JobRequest, response: Response) -> Job:
+    """Build a book in the background. Poll `/jobs/{id}` for progress, then fetch `/jobs/{id}/result`.
+
+    Jobs keep running if the client disconnects, and books built anonymously are stored for later downloads of the same book.
+    """
+    with start_action(
+        action_type="create_job",
+        download_id=job_request.download_id,
+        download_images=job_request.download_images,
+        format=job_request.format,
+        mode=job_request.mode,
+    ):
+        story_id, metadata, cookies = await fetch_download_metadata(
+            job_request.download_id,
+            job_request.mode,
+            job_request.username,
+            job_request.password,
         )
+        format, download_images = job_request.format, job_request.download_images
+
+        async def work(job_id: str, progress: Progress) -> tuple[str, bool]:
+            book_file, key = await obtain_book(
+                metadata,
+                story_id,
+                format,
+                download_images,
+                cookies,
+                requester_key(job_request.username, job_request.password),
+                progress,
+            )
+            with book_file:
+                if key:
+                    return key, True
+
+                # Credentials stay in this closure, they're never written to the broker.
+                await job_store.set_file(job_id, book_file)
+                return job_id, False
+
+        job = await job_queue.submit(
+            story_id,
+            format.value,
+            book_filename(metadata, story_id, format, download_images),
+            work,
+        )
+
+    response.headers["Location"] = f"/jobs/{job['id']}"
+    return job
+
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str) -> Job:
+    if not (job := await job_queue.get(job_id)):
+        raise HTTPException(status_code=404)
+
+    return job
+
+
+@app.get("/jobs/{job_id}/result")
+async def get_job_result(request: Request, job_id: str):
+    if not (job := await job_queue.get(job_id)):
+        raise HTTPException(status_code=404)
+
+    if job["status"] != "done" or not job["result"]:
+        return JSONResponse(status_code=409, content=job)
+
+    store = artifact_store if job["shared"] else job_store
+    if not store or not (book_file := await store.open(job["result"])):
+        raise HTTPException(status_code=410)  # Evicted
+
+    size = book_file.seek(0, SEEK_END)
+    book_file.seek(0)
+
+    return book_response(
+        request,
+        book_file,
+        size,
+        media_type=MEDIA_TYPES[DownloadFormat(job["format"])],
+        filename=job["filename"],
+        etag=job["result"] if job["shared"] else None,
+    )
+
+
+@app.get("/metrics")
+async def metrics():
+    """Connection pool, build queue and cache usage."""
+    return {
+        "pools": clients.metrics(),
+        "governor": await governor.metrics(),
+        "builds": scheduler.metrics(),
+        "images": await image_store.metrics() if image_store else None,
+        "parts": await part_store.metrics() if part_store else None,
+        "jobs": job_queue.metrics(),
+        "sessions": session_cache.metrics(),
+        "private": await private_cache.metrics() if private_cache else None,
+        "coalescing": {
+            "metadata": metadata_flights.metrics(),
+            "builds": builds.metrics(),
+            "private_builds": private_builds.metrics(),
+        },
+    }
 
 
 @app.get("/donate")
@@ -0,0 +1,235 @@
+"""Book delivery: chunked streaming with HTTP Range support and optional bandwidth shaping."""
+
+import asyncio
+import re
+import time
+from io import SEEK_END, BytesIO
+from typing import AsyncIterator, BinaryIO, Optional
+from zipfile import ZIP_STORED, ZipFile, ZipInfo
+
+from fastapi import Request
+from fastapi.responses import Response, StreamingResponse
+
+from create_book.ratelimit import TokenBucket
+from create_book.vars import config
+
+RANGE_PATTERN = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+class BandwidthLimiter:
+    """Shape download speed per client and across all clients. A rate of 0 disables that limit.
+
+    Args:
+        client_rate (int): Bytes per second for each client.
+        global_rate (int): Bytes per second shared by every client.
+        burst (int): Bytes a client may receive before shaping starts.
+    """
+
+    def __init__(self, client_rate: int, global_rate: int, burst: int):
+        self.client_rate = client_rate
+        self.burst = burst
+
+        self._global = TokenBucket(global_rate, burst) if global_rate else None
+        self._clients: dict[str, TokenBucket] = {}
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.client_rate or self._global)
+
+    def _client_bucket(self, client: str) -> TokenBucket:
+        if client not in self._clients:
+            if len(self._clients) > 1024:
+                # Forget clients that have finished downloading.
+                self._clients = {
+                    key: bucket
+                    for key, bucket in self._clients.items()
+                    if bucket.idle_for < 60
+                }
+            self._clients[client] = TokenBucket(self.client_rate, self.burst)
+
+        return self._clients[client]
+
+    async def consume(self, client: str, amount: int):
+        delay = 0.0
+        if self.client_rate:
+            delay = self._client_bucket(client).delay(amount)
+        if self._global:
+            delay = max(delay, self._global.delay(amount))
+
+        if delay:
+            await asyncio.sleep(delay)
+
+
+limiter = BandwidthLimiter(
+    client_rate=config.DOWNLOAD_CLIENT_RATE_LIMIT,
+    global_rate=config.DOWNLOAD_GLOBAL_RATE_LIMIT,
+    burst=config.DOWNLOAD_BURST,
+)
+
+
+def parse_range(header: str, size: int) -> Optional[tuple[int, int]]:
+    """Parse a single-range `Range` header into an inclusive (start, end) pair.
+
+    Returns:
+        Optional[tuple[int, int]]: None if the header is malformed or asks for multiple ranges, in which case the whole file is sent.
+
+    Raises:
+        ValueError: The range can't be satisfied.
+    """
+    match = RANGE_PATTERN.match(header.strip())
+    if not match:
+        return None
+
+    start, end = match.groups()
+    if not start and not end:
+        return None
+
+    if not start:  # Suffix range, the last `end` bytes
+        length = int(end)
+        if length == 0:
+            raise ValueError("Empty suffix range.")
+        return max(0, size - length), size - 1
+
+    first = int(start)
+    last = min(int(end), size - 1) if end else size - 1
+    if first >= size or first > last:
+        raise ValueError("Range not satisfiable.")
+
+    return first, last
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Whether an `If-None-Match` header lists `etag`, compared weakly, or is `*`."""
+    if not if_none_match:
+        return False
+
+    return any(
+        tag.strip() in ("*", f'"{etag}"', f'W/"{etag}"')
+        for tag in if_none_match.split(",")
+    )
+
+
+def book_response(
+    request: Request,
+    buffer: BinaryIO,
+    size: int,
+    media_type: str,
+    filename: str,
+    etag: Optional[str] = None,
+) -> Response:
+    """Stream a book, honouring `Range` requests so interrupted downloads can resume. `buffer` is closed once the response is sent."""
+    headers = {
+        "Content-Disposition": f'attachment; filename="{filename}"',  # Thanks https://stackoverflow.com/a/72729058
+        "Accept-Ranges": "bytes",
+    }
+    if etag:
+        headers["ETag"] = f'"{etag}"'
+
+    start, end = 0, size - 1
+    status_code = 200
+
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    if range_header and (not if_range or (etag and if_range.strip('"') == etag)):
+        try:
+            requested = parse_range(range_header, size)
+        except ValueError:
+            buffer.close()
+            return Response(
+                status_code=416, headers={**headers, "Content-Range": f"bytes */{size}"}
+            )
+
+        if requested:
+            start, end = requested
+            status_code = 206
+            headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+
+    headers["Content-Length"] = str(end - start + 1)
+
+    client = request.client.host if request.client else ""
+    chunk_size = config.DOWNLOAD_CHUNK_SIZE
+    in_memory = isinstance(buffer, BytesIO)
+
+    async def iterfile():
+        try:
+            buffer.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                amount = min(chunk_size, remaining)
+                chunk = (
+                    buffer.read(amount)
+                    if in_memory
+                    else await asyncio.to_thread(buffer.read, amount)
+                )
+                if not chunk:
+                    break
+
+                if limiter.enabled:
+                    await limiter.consume(client, len(chunk))
+
+                remaining -= len(chunk)
+                yield chunk
+        finally:
+            buffer.close()
+
+    return StreamingResponse(
+        iterfile(), status_code=status_code, media_type=media_type, headers=headers
+    )
+
+
+class _ZipSink:
+    """Write-only file collecting ZipFile's output until it's sent. It isn't seekable, so ZipFile follows each entry with a data descriptor instead of seeking back to its header."""
+
+    def __init__(self):
+        self.chunks: list[bytes] = []
+
+    def write(self, data: bytes) -> int:
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self) -> bytes:
+        data = b"".join(self.chunks)
+        self.chunks.clear()
+        return data
+
+
+def archive_response(
+    request: Request, books: AsyncIterator[tuple[str, BinaryIO]], filename: str
+) -> Response:
+    """Stream a zip of `books`, as (filename, file) pairs, writing each entry as it arrives. Files are closed once they're sent.
+
+    Books are already compressed, so entries are stored as-is. The archive's size isn't known upfront, so Range requests aren't supported.
+    """
+    headers = {"Content-Disposition": f'attachment; filename="{filename}"'}
+
+    client = request.client.host if request.client else ""
+    chunk_size = config.DOWNLOAD_CHUNK_SIZE
+
+    async def send(data: bytes) -> bytes:
+        if limiter.enabled:
+            await limiter.consume(client, len(data))
+        return data
+
+    async def iterzip():
+        sink = _ZipSink()
+        with ZipFile(sink, "w", ZIP_STORED) as archive:
+            async for name, buffer in books:
+                with buffer:
+                    info = ZipInfo(name, time.localtime()[:6])
+                    # Decides whether the entry needs ZIP64
+                    info.file_size = buffer.seek(0, SEEK_END)
+                    buffer.seek(0)
+
+                    with archive.open(info, "w") as entry:
+                        while chunk := await asyncio.to_thread(buffer.read, chunk_size):
+                            entry.write(chunk)
+                            yield await send(sink.take())
+
+                yield await send(sink.take())
+
+        yield await send(sink.take())  # Central directory
+
+    return StreamingResponse(iterzip(), media_type="application/zip", headers=headers)